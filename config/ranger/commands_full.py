@@ -91,11 +91,11 @@
 
 from __future__ import (absolute_import, division, print_function)
 
-from collections import deque
 import os
 import re
 
 from ranger.api.commands import Command
+from ranger.core.loader import Loadable
 
 
 class alias(Command):
@@ -125,6 +125,214 @@ class echo(Command):
         self.fm.notify(self.rest(1))
 
 
+class _JsonStore(object):
+    """Base class for small caches that are persisted as a JSON file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        import json
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r') as fobj:
+                self.entries = json.load(fobj)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def snapshot(self):
+        """Returns the entries as they are to be saved"""
+        return self.entries
+
+    def save(self):
+        import json
+        if not self.path or not self.dirty:
+            return
+        self.dirty = False
+        tmppath = self.path + '.tmp'
+        try:
+            with open(tmppath, 'w') as fobj:
+                json.dump(self.snapshot(), fobj, separators=(',', ':'))
+            os.rename(tmppath, self.path)
+        except (IOError, OSError):
+            self.dirty = True
+
+
+class _DirIndex(_JsonStore):
+    """A persistent cache of subdirectory listings, keyed by parent path.
+
+    Every entry remembers the mtime of the parent directory at the time it
+    was listed.  A listing is only redone when that mtime changes, so a
+    lookup usually costs a single stat() instead of a full directory read.
+    Listings may be added from worker threads while the index is saved.
+    """
+
+    def __init__(self, path):
+        import threading
+        self.lock = threading.Lock()
+        _JsonStore.__init__(self, path)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.entries)
+
+    def subdirs(self, path):
+        """Returns a list of the names of all subdirectories of path"""
+        path = os.path.normpath(path)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return []
+
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == mtime:
+            return list(entry[1])
+
+        try:
+            dirnames = next(os.walk(path))[1]
+        except StopIteration:
+            dirnames = []
+        with self.lock:
+            self.entries[path] = [mtime, dirnames]
+            self.dirty = True
+        return list(dirnames)
+
+
+class _Frecency(_JsonStore):
+    """Visit counts and times of directories, used to rank completions.
+
+    The score of a directory grows with every visit and decays with the
+    time since the last one.  When the sum of all counts exceeds
+    max_total, all counts are aged so that old entries eventually vanish.
+    """
+    max_total = 5000
+
+    def visit(self, path):
+        from time import time
+        count = self.entries.get(path, (0, 0))[0]
+        self.entries[path] = [count + 1, time()]
+        self.dirty = True
+
+        if sum(entry[0] for entry in self.entries.values()) > self.max_total:
+            for key, (count, last) in list(self.entries.items()):
+                if count * 0.9 < 1:
+                    del self.entries[key]
+                else:
+                    self.entries[key] = [count * 0.9, last]
+
+    def score(self, path):
+        from time import time
+        try:
+            count, last = self.entries[path]
+        except KeyError:
+            return 0
+        age = time() - last
+        if age < 3600:
+            return count * 4
+        if age < 86400:
+            return count * 2
+        if age < 604800:
+            return count / 2
+        return count / 4
+
+
+def _fuzzy_score(pattern, name, word_start_bonus=8):
+    """Scores how well pattern matches name as a subsequence.
+
+    Returns None if the characters of pattern don't appear in name in order.
+    Matches at the start of the name or of a word and runs of consecutive
+    characters are rewarded, every skipped character is penalized.
+    """
+    score = 0
+    pos = 0
+    for char in pattern:
+        idx = name.find(char, pos)
+        if idx < 0:
+            return None
+        if idx == 0:
+            score += 8
+        else:
+            bonus = 0
+            if pos and idx == pos:
+                bonus = 5
+            if name[idx - 1] in ' -_.':
+                bonus = max(bonus, word_start_bonus)
+            score += bonus
+        score -= idx - pos
+        pos = idx + 1
+    return score - 0.1 * (len(name) - len(pattern))
+
+
+class _PrefixIndex(object):
+    """A sorted list of paths that can be searched by parent directory"""
+
+    def __init__(self, paths):
+        self.paths = sorted(set(paths))
+
+    def below(self, path):
+        """Returns all indexed paths that lie inside the directory path"""
+        from bisect import bisect_left
+        # Everything starting with "path/" sorts between "path/" and "path0"
+        start = bisect_left(self.paths, path + os.path.sep)
+        end = bisect_left(self.paths, path + chr(ord(os.path.sep) + 1), start)
+        return self.paths[start:end]
+
+
+def _threaded_imap(func, items, workers, deadline=None):
+    """Applies func to every item in up to `workers' daemon threads.
+
+    Results are yielded in the order in which they finish.  Iteration stops
+    early at the time.time() value `deadline'.  Once the caller stops
+    iterating, the remaining items are dropped; threads that are busy with an
+    item finish it in the background without blocking the caller.
+    """
+    import threading
+    from time import time
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue  # pylint: disable=import-error
+
+    items = list(items)
+    todo = queue.Queue()
+    done = queue.Queue()
+    stop = threading.Event()
+    for item in items:
+        todo.put(item)
+
+    def work():
+        while not stop.is_set():
+            try:
+                item = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                done.put((True, func(item)))
+            except Exception:  # pylint: disable=broad-except
+                done.put((False, None))
+
+    for _ in range(min(workers, len(items))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for _ in items:
+            timeout = None if deadline is None else max(0, deadline - time())
+            try:
+                success, result = done.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if success:
+                yield result
+    finally:
+        stop.set()
+
+
 class cd(Command):
     """:cd [-r] <path>
 
@@ -132,9 +340,29 @@ class cd(Command):
     If the path is a file, selects that file.
     The command 'cd -' is equivalent to typing ``.
     Using the option "-r" will get you to the real path.
+
+    Tab completion reads subdirectories through an index that is stored in
+    datadir/cd_index and refreshed whenever a directory's mtime changes.
+    With the option cd_tab_fuzzy, path components are matched as
+    subsequences and the candidates are ranked by match quality and by how
+    often and how recently they were visited (see datadir/cd_frecency).
     """
+    dir_index_filename = 'cd_index'
+    frecency_filename = 'cd_frecency'
+    frecency_weight = 1
+    # Limits for the fuzzy search: threads listing directories in parallel,
+    # seconds per completion and candidates per path component
+    fuzzy_workers = 8
+    fuzzy_time_budget = 0.5
+    fuzzy_max_candidates = 2000
+    _dir_index = None
+    _frecency = None
+    _bookmark_index = None
+    _bookmark_paths = None
 
     def execute(self):
+        self._get_dir_index().save()
+
         if self.arg(1) == '-r':
             self.shift()
             destination = os.path.realpath(self.rest(1))
@@ -152,6 +380,33 @@ class cd(Command):
         else:
             self.fm.cd(destination)
 
+        frecency = self._get_frecency()
+        frecency.visit(self.fm.thisdir.path)
+        frecency.save()
+
+    def cancel(self):
+        self._get_dir_index().save()
+
+    def _get_dir_index(self):
+        if cd._dir_index is None:
+            cd._dir_index = _DirIndex(self.fm.datapath(self.dir_index_filename))
+        return cd._dir_index
+
+    def _get_frecency(self):
+        if cd._frecency is None:
+            cd._frecency = _Frecency(self.fm.datapath(self.frecency_filename))
+        return cd._frecency
+
+    def _get_bookmark_index(self):
+        paths = tuple(bookmark.path for bookmark in self.fm.bookmarks.dct.values())
+        if paths != cd._bookmark_paths:
+            cd._bookmark_index = _PrefixIndex(paths)
+            cd._bookmark_paths = paths
+        return cd._bookmark_index
+
+    def _subdirs(self, path):
+        return self._get_dir_index().subdirs(path)
+
     def _tab_args(self):
         # dest must be rest because path could contain spaces
         if self.arg(1) == '-r':
@@ -172,59 +427,76 @@ class cd(Command):
         return (start, dest_exp, os.path.join(self.fm.thisdir.path, dest_exp),
                 dest.endswith(os.path.sep))
 
-    @staticmethod
-    def _tab_paths(dest, dest_abs, ends_with_sep):
+    def _tab_paths(self, dest, dest_abs, ends_with_sep):
         if not dest:
-            try:
-                return next(os.walk(dest_abs))[1], dest_abs
-            except (OSError, StopIteration):
-                return [], ''
+            return self._subdirs(dest_abs), dest_abs
 
         if ends_with_sep:
-            try:
-                return [os.path.join(dest, path) for path in next(os.walk(dest_abs))[1]], ''
-            except (OSError, StopIteration):
-                return [], ''
+            return [os.path.join(dest, path) for path in self._subdirs(dest_abs)], ''
 
         return None, None
 
-    def _tab_match(self, path_user, path_file):
+    def _tab_case(self, path_user, path_file):
         if self.fm.settings.cd_tab_case == 'insensitive':
             path_user = path_user.lower()
             path_file = path_file.lower()
         elif self.fm.settings.cd_tab_case == 'smart' and path_user.islower():
             path_file = path_file.lower()
+        return path_user, path_file
+
+    def _tab_match(self, path_user, path_file):
+        path_user, path_file = self._tab_case(path_user, path_file)
         return path_file.startswith(path_user)
 
+    def _tab_score(self, path_user, path_file):
+        path_user, path_file = self._tab_case(path_user, path_file)
+        return _fuzzy_score(path_user, path_file)
+
     def _tab_normal(self, dest, dest_abs):
         dest_dir = os.path.dirname(dest)
         dest_base = os.path.basename(dest)
 
-        try:
-            dirnames = next(os.walk(os.path.dirname(dest_abs)))[1]
-        except (OSError, StopIteration):
-            return [], ''
+        dirnames = self._subdirs(os.path.dirname(dest_abs))
 
         return [os.path.join(dest_dir, d) for d in dirnames if self._tab_match(dest_base, d)], ''
 
     def _tab_fuzzy_match(self, basepath, tokens):
-        """ Find directories matching tokens recursively """
+        """ Find directories matching tokens recursively
+
+        Returns a list of (path, score) tuples.  The directories of each
+        level are listed in parallel.  When too many candidates were found,
+        the search continues with what has been found so far.  When the time
+        budget is used up, the matches of the deepest level that had any are
+        returned.  The first level is always listed completely.
+        """
+        from time import time
+
         if not tokens:
             tokens = ['']
-        paths = [basepath]
+        deadline = time() + self.fuzzy_time_budget
+        level_deadline = None
+        paths = [(basepath, 0)]
+        found = []
         while True:
             token = tokens.pop()
             matches = []
-            for path in paths:
-                try:
-                    directories = next(os.walk(path))[1]
-                except (OSError, StopIteration):
-                    continue
-                matches += [os.path.join(path, d) for d in directories
-                            if self._tab_match(token, d)]
+            listings = _threaded_imap(
+                lambda item: (item, self._subdirs(item[0])),
+                paths, self.fuzzy_workers, level_deadline)
+            for (path, score), dirnames in listings:
+                for dirname in dirnames:
+                    dirscore = self._tab_score(token, dirname)
+                    if dirscore is not None:
+                        matches.append((os.path.join(path, dirname), score + dirscore))
+                if len(matches) >= self.fuzzy_max_candidates:
+                    listings.close()
+                    break
+            if not matches and time() >= deadline:
+                return found
             if not tokens or not matches:
                 return matches
-            paths = matches
+            found = paths = matches
+            level_deadline = deadline
 
         return None
 
@@ -241,7 +513,11 @@ class cd(Command):
                 break
             tokens.append(token)
 
-        paths = self._tab_fuzzy_match(basepath, tokens)
+        frecency = self._get_frecency()
+        matches = self._tab_fuzzy_match(basepath, tokens)
+        matches.sort(key=lambda match: (
+            -(match[1] + self.frecency_weight * frecency.score(match[0])), match[0]))
+        paths = [path for path, _ in matches]
         if not os.path.isabs(dest):
             paths_rel = self.fm.thisdir.path
             paths = [os.path.relpath(os.path.join(basepath, path), paths_rel)
@@ -258,18 +534,25 @@ class cd(Command):
         paths, paths_rel = self._tab_paths(dest, dest_abs, ends_with_sep)
         if paths is None:
             if self.fm.settings.cd_tab_fuzzy:
+                # already ranked, best match first
                 paths, paths_rel = self._tab_fuzzy(dest, dest_abs)
             else:
                 paths, paths_rel = self._tab_normal(dest, dest_abs)
-
-        paths.sort()
+                paths.sort()
+        else:
+            paths.sort()
 
         if self.fm.settings.cd_bookmarks:
-            paths[0:0] = [
-                os.path.relpath(v.path, paths_rel) if paths_rel else v.path
-                for v in self.fm.bookmarks.dct.values() for path in paths
-                if v.path.startswith(os.path.join(paths_rel, path) + sep)
-            ]
+            bookmark_index = self._get_bookmark_index()
+            bookmarks = []
+            seen = set()
+            for path in paths:
+                for bookmark in bookmark_index.below(os.path.join(paths_rel, path)):
+                    if bookmark not in seen:
+                        seen.add(bookmark)
+                        bookmarks.append(
+                            os.path.relpath(bookmark, paths_rel) if paths_rel else bookmark)
+            paths[0:0] = bookmarks
 
         if not paths:
             return None
@@ -644,6 +927,178 @@ class terminal(Command):
         self.fm.run(get_term(), flags='f')
 
 
+def _is_directory_with_files(path):
+    """Whether path is a real directory with at least one entry
+
+    Stops reading the directory at the first entry.
+    """
+    if not os.path.isdir(path) or os.path.islink(path):
+        return False
+    try:
+        scandir = os.scandir
+    except AttributeError:
+        return len(os.listdir(path)) > 0
+    try:
+        entries = scandir(path)
+    except OSError:
+        return False
+    try:
+        for _ in entries:
+            return True
+        return False
+    finally:
+        if hasattr(entries, 'close'):
+            entries.close()
+
+
+class _DeleteLoader(Loadable):
+    """Deletes files and directory trees in the background
+
+    Trees are removed bottom-up while they are read with os.scandir.
+    Where the platform supports it, every directory is opened once and
+    its entries are removed relative to that descriptor (unlinkat), so
+    no path has to be resolved twice.  The number of removed entries and
+    the rate are shown in the task's description.
+    """
+
+    progressbar_supported = True
+    batch_size = 256
+
+    def __init__(self, fm, paths):
+        Loadable.__init__(self, self.generate(), 'Deleting')
+        self.fm = fm
+        self.paths = paths
+        self.removed = 0
+        self.found = 0
+        self.errors = []
+        self.started = None
+        self.finished = False
+
+    def get_description(self):
+        from time import time
+
+        if not self.started:
+            return 'Deleting %s' % ', '.join(os.path.basename(path) for path in self.paths)
+        rate = self.removed / max(time() - self.started, 0.001)
+        return 'Deleting: %d entries removed, %d/s' % (self.removed, rate)
+
+    def destroy(self):
+        # Removed from the taskview: stop, closing the open directories, and
+        # clean up after what has been deleted so far
+        generator, self.load_generator = self.load_generator, None
+        if generator is not None:
+            generator.close()
+        self._finish()
+
+    def generate(self):
+        from time import time
+
+        self.started = time()
+        use_fd = os.scandir in getattr(os, 'supports_fd', ()) and \
+            os.unlink in getattr(os, 'supports_dir_fd', ()) and \
+            os.rmdir in getattr(os, 'supports_dir_fd', ())
+        for path in self.paths:
+            self.found += 1
+            if os.path.isdir(path) and not os.path.islink(path):
+                for _ in self._remove_tree(path, use_fd):
+                    yield
+            else:
+                try:
+                    os.remove(path)
+                    self.removed += 1
+                except OSError as ex:
+                    self.errors.append(ex)
+            self.percent = 100 * self.removed // max(1, self.found)
+            yield
+        self._finish()
+
+    def _remove_tree(self, path, use_fd):
+        """Removes a directory tree, yielding every `batch_size' entries"""
+        # Every frame is [directory, its name or path, entries, fd]
+        stack = []
+
+        def enter(name_or_path, parent_fd):
+            if use_fd:
+                fd = os.open(name_or_path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)
+                             | getattr(os, 'O_NOFOLLOW', 0), dir_fd=parent_fd)
+                stack.append([name_or_path, os.scandir(fd), fd])
+            else:
+                stack.append([name_or_path, os.scandir(name_or_path), None])
+
+        def leave():
+            name_or_path, entries, fd = stack.pop()
+            if hasattr(entries, 'close'):
+                entries.close()
+            if fd is not None:
+                os.close(fd)
+            try:
+                if use_fd:
+                    os.rmdir(name_or_path, dir_fd=stack[-1][2] if stack else None)
+                else:
+                    os.rmdir(name_or_path)
+                self.removed += 1
+            except OSError as ex:
+                self.errors.append(ex)
+
+        try:
+            try:
+                enter(path, None)
+            except OSError as ex:
+                self.errors.append(ex)
+                return
+            count = 0
+            while stack:
+                _, entries, fd = stack[-1]
+                for entry in entries:
+                    self.found += 1
+                    target = entry.name if use_fd else entry.path
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            enter(target, fd)
+                            break
+                        if use_fd:
+                            os.unlink(target, dir_fd=fd)
+                        else:
+                            os.unlink(target)
+                        self.removed += 1
+                    except OSError as ex:
+                        self.errors.append(ex)
+                    count += 1
+                    if count % self.batch_size == 0:
+                        self.percent = 100 * self.removed // max(1, self.found)
+                        yield
+                else:
+                    leave()
+        finally:
+            while stack:
+                _, entries, fd = stack.pop()
+                if hasattr(entries, 'close'):
+                    entries.close()
+                if fd is not None:
+                    os.close(fd)
+
+    def _finish(self):
+        from time import time
+
+        if self.finished:
+            return
+        self.finished = True
+        fm = self.fm
+        paths = self.paths
+        tags = [tag for tag in fm.tags.tags
+                if any(tag == path or tag.startswith(path + '/') for path in paths)]
+        if tags:
+            fm.tags.remove(*tags)
+        fm.copy_buffer = set(fobj for fobj in fm.copy_buffer if fobj.path not in paths)
+        fm.thistab.ensure_correct_pointer()
+        if self.errors:
+            fm.notify("Could not delete %d entries: %s" % (len(self.errors), self.errors[0]),
+                      bad=True)
+        else:
+            elapsed = time() - self.started if self.started else 0
+            fm.notify("Deleted %d entries in %.1fs" % (self.removed, elapsed))
+
+
 class delete(Command):
     """:delete
 
@@ -656,6 +1111,9 @@ class delete(Command):
 
     When attempting to delete non-empty directories or multiple
     marked files, it will require a confirmation.
+
+    Files are deleted in the background; remove the task from the task
+    view to stop.
     """
 
     allow_abbrev = False
@@ -665,12 +1123,9 @@ class delete(Command):
         import shlex
         from functools import partial
 
-        def is_directory_with_files(path):
-            return os.path.isdir(path) and not os.path.islink(path) and len(os.listdir(path)) > 0
-
         if self.rest(1):
             files = shlex.split(self.rest(1))
-            many_files = (len(files) > 1 or is_directory_with_files(files[0]))
+            many_files = (len(files) > 1 or _is_directory_with_files(files[0]))
         else:
             cwd = self.fm.thisdir
             tfile = self.fm.thisfile
@@ -680,7 +1135,7 @@ class delete(Command):
 
             # relative_path used for a user-friendly output in the confirmation.
             files = [f.relative_path for f in self.fm.thistab.get_selection()]
-            many_files = (cwd.marked_items or is_directory_with_files(tfile.path))
+            many_files = (cwd.marked_items or _is_directory_with_files(tfile.path))
 
         confirm = self.fm.settings.confirm_on_delete
         if confirm != 'never' and (confirm != 'multiple' or many_files):
@@ -691,21 +1146,194 @@ class delete(Command):
             )
         else:
             # no need for a confirmation, just delete
-            self.fm.delete(files)
+            self._delete(files)
 
     def tab(self, tabnum):
         return self._tab_directory_content()
 
     def _question_callback(self, files, answer):
         if answer == 'y' or answer == 'Y':
-            self.fm.delete(files)
+            self._delete(files)
+
+    def _delete(self, files):
+        self.fm.notify("Deleting {}!".format(", ".join(files)))
+        self.fm.loader.add(_DeleteLoader(self.fm, [os.path.abspath(path) for path in files]))
+
+
+class _Trash(object):
+    """A trash can as described by the freedesktop.org trash specification
+
+    `path' is the trash directory that contains files/ and info/.  For a
+    trash can at the top of a mount point, `topdir' is that mount point and
+    the original paths are stored relative to it.
+    """
+
+    def __init__(self, path, topdir=None):
+        self.path = path
+        self.topdir = topdir
+        self.files_dir = os.path.join(path, 'files')
+        self.info_dir = os.path.join(path, 'info')
+
+    @classmethod
+    def home(cls):
+        data_home = os.environ.get('XDG_DATA_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.local', 'share')
+        return cls(os.path.join(data_home, 'Trash'))
+
+    @classmethod
+    def for_path(cls, path):
+        """Returns the trash can that path can be moved to by renaming it"""
+        import stat
+        from ranger.ext.mount_path import mount_path
+
+        home = cls.home()
+        existing = home.path
+        while not os.path.exists(existing):
+            existing = os.path.dirname(existing)
+        device = os.lstat(path).st_dev
+        if os.stat(existing).st_dev == device:
+            return home
+        topdir = mount_path(os.path.dirname(os.path.abspath(path)))
+        uid = str(os.getuid())
+        shared = os.path.join(topdir, '.Trash')
+        try:
+            mode = os.lstat(shared).st_mode
+            if stat.S_ISDIR(mode) and mode & stat.S_ISVTX:
+                return cls(os.path.join(shared, uid), topdir)
+        except OSError:
+            pass
+        return cls(os.path.join(topdir, '.Trash-' + uid), topdir)
+
+    def _encode(self, path):
+        try:
+            from urllib.parse import quote
+        except ImportError:
+            from urllib import quote  # pylint: disable=no-name-in-module
+        if self.topdir is not None:
+            path = os.path.relpath(path, self.topdir)
+        return quote(path, safe='/')
+
+    def _decode(self, value):
+        try:
+            from urllib.parse import unquote
+        except ImportError:
+            from urllib import unquote  # pylint: disable=no-name-in-module
+        path = unquote(value)
+        if self.topdir is not None and not os.path.isabs(path):
+            path = os.path.join(self.topdir, path)
+        return path
+
+    def put(self, paths):
+        """Moves paths into the trash.  Returns a list of (path, error)
+
+        The info directory is read once to pick unused names, and all
+        entries share one deletion date.
+        """
+        import errno
+        from time import strftime
+
+        for directory in (self.files_dir, self.info_dir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+        taken = set(os.listdir(self.info_dir))
+        date = strftime('%Y-%m-%dT%H:%M:%S')
+        errors = []
+        for path in paths:
+            path = os.path.abspath(path)
+            base = os.path.basename(path)
+            name = base
+            number = 1
+            while True:
+                while name + '.trashinfo' in taken:
+                    number += 1
+                    name = '%s.%d' % (base, number)
+                info = os.path.join(self.info_dir, name + '.trashinfo')
+                try:
+                    fd = os.open(info, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                except OSError as ex:
+                    if ex.errno != errno.EEXIST:
+                        errors.append((path, ex))
+                        fd = None
+                        break
+                    taken.add(name + '.trashinfo')
+                    continue
+                break
+            if fd is None:
+                continue
+            taken.add(name + '.trashinfo')
+            with os.fdopen(fd, 'w') as fobj:
+                fobj.write('[Trash Info]\nPath=%s\nDeletionDate=%s\n' % (
+                    self._encode(path), date))
+            try:
+                os.rename(path, os.path.join(self.files_dir, name))
+            except OSError as ex:
+                os.remove(info)
+                errors.append((path, ex))
+        return errors
+
+    def entries(self):
+        """Returns a list of (name, original path, deletion date)"""
+        try:
+            names = os.listdir(self.info_dir)
+        except OSError:
+            return []
+        entries = []
+        for info in names:
+            if not info.endswith('.trashinfo'):
+                continue
+            values = {}
+            try:
+                with open(os.path.join(self.info_dir, info), 'r') as fobj:
+                    for line in fobj:
+                        key, _, value = line.rstrip('\n').partition('=')
+                        values[key] = value
+            except (IOError, OSError):
+                continue
+            if 'Path' in values:
+                entries.append((info[:-len('.trashinfo')], self._decode(values['Path']),
+                                values.get('DeletionDate', '')))
+        return entries
+
+    def restore(self, names):
+        """Moves entries back to where they came from.  Returns a list of errors"""
+        entries = dict((name, path) for name, path, _ in self.entries())
+        errors = []
+        for name in names:
+            path = entries.get(name)
+            if path is None:
+                errors.append("%s is not in the trash" % name)
+                continue
+            if os.path.lexists(path):
+                errors.append("%s already exists" % path)
+                continue
+            try:
+                parent = os.path.dirname(path)
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                os.rename(os.path.join(self.files_dir, name), path)
+                os.remove(os.path.join(self.info_dir, name + '.trashinfo'))
+            except OSError as ex:
+                errors.append("%s: %s" % (path, ex.strerror or ex))
+        return errors
+
 
+def _trash_cans(path):
+    """Returns the home trash can and the one for the mount point of path"""
+    cans = [_Trash.home()]
+    try:
+        can = _Trash.for_path(path)
+    except OSError:
+        return cans
+    if can.path != cans[0].path:
+        cans.append(can)
+    return cans
 
-class trash(Command):
+
+class trash(delete):
     """:trash
 
     Tries to move the selection or the files passed in arguments (if any) to
-    the trash, using rifle rules with label "trash".
+    the trash, following the freedesktop.org trash specification.
     The arguments use a shell-like escaping.
 
     "Selection" is defined as all the "marked files" (by default, you
@@ -714,49 +1342,87 @@ class trash(Command):
 
     When attempting to trash non-empty directories or multiple
     marked files, it will require a confirmation.
+
+    Files are renamed into the trash can of their file system: the one in
+    $XDG_DATA_HOME for the home file system, $topdir/.Trash-$UID otherwise.
+    See also :trash_list and :trash_restore.
     """
 
-    allow_abbrev = False
-    escape_macros_for_shell = True
+    def _delete(self, files):
+        cans = {}
+        for path in files:
+            try:
+                can = _Trash.for_path(path)
+            except OSError as ex:
+                self.fm.notify("Can't trash %s: %s" % (path, ex), bad=True)
+                continue
+            cans.setdefault(can.path, (can, []))[1].append(path)
+        errors = []
+        for can, paths in cans.values():
+            try:
+                errors.extend(can.put(paths))
+            except OSError as ex:
+                errors.extend((path, ex) for path in paths)
+        if errors:
+            self.fm.notify("Could not trash %d files: %s: %s" % (
+                len(errors), errors[0][0], errors[0][1]), bad=True)
+        self.fm.thistab.ensure_correct_pointer()
+
+
+class trash_list(Command):
+    """:trash_list
+
+    Shows the contents of the trash cans the current directory can use in
+    the pager, most recently trashed first.
+    """
 
     def execute(self):
-        import shlex
-        from functools import partial
+        entries = []
+        for can in _trash_cans(self.fm.thisdir.path):
+            entries.extend(can.entries())
+        entries.sort(key=lambda entry: entry[2], reverse=True)
+        pager = self.fm.ui.open_pager()
+        pager.set_source(["%s  %s" % (date.replace('T', ' '), path)
+                          for _, path, date in entries] or ["The trash is empty"])
 
-        def is_directory_with_files(path):
-            return os.path.isdir(path) and not os.path.islink(path) and len(os.listdir(path)) > 0
 
-        if self.rest(1):
-            files = shlex.split(self.rest(1))
-            many_files = (len(files) > 1 or is_directory_with_files(files[0]))
-        else:
-            cwd = self.fm.thisdir
-            tfile = self.fm.thisfile
-            if not cwd or not tfile:
-                self.fm.notify("Error: no file selected for deletion!", bad=True)
-                return
+class trash_restore(Command):
+    """:trash_restore [<file>...]
 
-            # relative_path used for a user-friendly output in the confirmation.
-            files = [f.relative_path for f in self.fm.thistab.get_selection()]
-            many_files = (cwd.marked_items or is_directory_with_files(tfile.path))
+    Restores files that were trashed from the current directory.  Without
+    arguments, restores the files that were trashed from here last.
+    """
 
-        confirm = self.fm.settings.confirm_on_delete
-        if confirm != 'never' and (confirm != 'multiple' or many_files):
-            self.fm.ui.console.ask(
-                "Confirm deletion of: %s (y/N)" % ', '.join(files),
-                partial(self._question_callback, files),
-                ('n', 'N', 'y', 'Y'),
-            )
+    def execute(self):
+        import shlex
+
+        cwd = self.fm.thisdir.path
+        wanted = set(os.path.join(cwd, name) for name in shlex.split(self.rest(1)))
+        found = [(can, name, path, date) for can in _trash_cans(cwd)
+                 for name, path, date in can.entries() if os.path.dirname(path) == cwd]
+        if wanted:
+            found = [entry for entry in found if entry[2] in wanted]
+        elif found:
+            latest = max(date for _, _, _, date in found)
+            found = [entry for entry in found if entry[3] == latest]
+        if not found:
+            self.fm.notify("Nothing to restore", bad=True)
+            return
+        errors = []
+        for can in set(can for can, _, _, _ in found):
+            errors.extend(can.restore([name for other, name, _, _ in found if other is can]))
+        if errors:
+            self.fm.notify("Could not restore %d files: %s" % (len(errors), errors[0]),
+                           bad=True)
         else:
-            # no need for a confirmation, just delete
-            self.fm.execute_file(files, label='trash')
+            self.fm.notify("Restored %d files" % len(found))
 
     def tab(self, tabnum):
-        return self._tab_directory_content()
-
-    def _question_callback(self, files, answer):
-        if answer == 'y' or answer == 'Y':
-            self.fm.execute_file(files, label='trash')
+        cwd = self.fm.thisdir.path
+        names = sorted(set(os.path.basename(path) for can in _trash_cans(cwd)
+                           for _, path, _ in can.entries()
+                           if os.path.dirname(path) == cwd))
+        return [self.start(1) + name for name in names if name.startswith(self.rest(1))]
 
 
 class jump_non(Command):
@@ -1113,15 +1779,214 @@ class chmod(Command):
         self.fm.thisdir.content_outdated = True
 
 
+def _remap_paths(fm, moves):
+    """Points the tags, bookmarks and metadata of moved files to their new paths
+
+    `moves' is a list of (old, new) absolute paths.  Paths below a moved
+    directory are remapped as well.  Every store is read and written at
+    most once, however many files were moved.
+    """
+    import json
+    from ranger.core.metadata import METADATA_FILE_NAME
+
+    mapping = dict(moves)
+    if not mapping:
+        return
+
+    def remap(path):
+        parent = path
+        while parent not in mapping:
+            head = os.path.dirname(parent)
+            if head == parent:
+                return None
+            parent = head
+        return mapping[parent] + path[len(parent):]
+
+    tags = fm.tags
+    if tags is not None:
+        tags.sync()
+        changed = False
+        new_tags = {}
+        for path, tag in tags.tags.items():
+            new = remap(path)
+            changed |= new is not None
+            new_tags[new or path] = tag
+        if changed:
+            tags.tags = new_tags
+            tags.dump()
+
+    bookmarks = fm.bookmarks
+    if bookmarks is not None:
+        bookmarks.update_if_outdated()
+        changed = False
+        for key, bfile in list(bookmarks):
+            new = remap(bfile.path)
+            if new:
+                bookmarks.dct[key] = bookmarks.bookmarktype(new)
+                changed = True
+        if changed:
+            bookmarks.save()
+
+    # pylint: disable=protected-access
+    metadata = fm.metadata
+    changed = set()
+    for old, new in mapping.items():
+        try:
+            metafile = metadata._get_metafile_name(old)
+            entries = metadata._get_metafile_content(metafile)
+        except ValueError:
+            continue
+        for key in (old, os.path.basename(old)):
+            if key in entries:
+                entry = entries.pop(key)
+                break
+        else:
+            continue
+        new_metafile = os.path.join(os.path.dirname(new), METADATA_FILE_NAME)
+        try:
+            new_entries = metadata._get_metafile_content(new_metafile)
+        except ValueError:
+            continue
+        new_entries[os.path.basename(new)] = entry
+        metadata.metafile_cache[metafile] = entries
+        metadata.metafile_cache[new_metafile] = new_entries
+        metadata.metadata_cache.pop(old, None)
+        metadata.metadata_cache.pop(new, None)
+        changed.update((metafile, new_metafile))
+    for metafile in changed:
+        try:
+            with open(metafile, "w") as fobj:
+                json.dump(metadata.metafile_cache[metafile], fobj,
+                          check_circular=True, indent=2)
+        except (IOError, OSError) as ex:
+            fm.notify("Could not update %s: %s" % (metafile, ex), bad=True)
+
+
+class _RenamePlan(object):
+    """Renames a batch of files in-process
+
+    `moves' is a list of (old, new) absolute paths.  Moves are ordered so
+    that no file is overwritten by another one of the batch, and cycles
+    (a -> b, b -> a) go through a temporary name.  Missing parent
+    directories are created first.  If a rename fails, all renames done so
+    far are undone and the created directories are removed again.
+    """
+
+    def __init__(self, moves):
+        self.moves = [(old, new) for old, new in moves if old != new]
+
+    def problems(self):
+        """Returns a list of reasons why the plan can't be carried out"""
+        problems = []
+        sources = set(old for old, _ in self.moves)
+        targets = set()
+        for old, new in self.moves:
+            if not os.path.lexists(old):
+                problems.append("%s does not exist" % old)
+            if new in targets:
+                problems.append("%s is the target of several renames" % new)
+            targets.add(new)
+            if os.path.lexists(new) and new not in sources:
+                try:
+                    same = os.path.samefile(old, new)
+                except OSError:
+                    same = False
+                if not same:
+                    problems.append("%s already exists" % new)
+        return problems
+
+    def directories(self):
+        """Returns the directories that have to be created, parents first"""
+        missing = set()
+        for _, new in self.moves:
+            parent = os.path.dirname(new)
+            while parent and parent not in missing and not os.path.isdir(parent):
+                missing.add(parent)
+                parent = os.path.dirname(parent)
+        return sorted(missing)
+
+    def steps(self):
+        """Returns the list of (src, dst) renames in the order they are done"""
+        pending = dict(self.moves)
+        steps = []
+        for start, _ in self.moves:
+            if start not in pending:
+                continue
+            # Everything the file is renamed to has to move out of the way
+            # first, so follow the chain of moves to its free end.
+            chain = [start]
+            seen = set(chain)
+            node = pending[start]
+            # Stop at a file that is already part of the chain too, which
+            # only happens if the plan has problems()
+            while node in pending and node not in seen:
+                chain.append(node)
+                seen.add(node)
+                node = pending[node]
+            if node == start:
+                tmp = self._temporary_name(start)
+                steps.append((start, tmp))
+                steps.extend((src, pending[src]) for src in reversed(chain[1:]))
+                steps.append((tmp, pending[start]))
+            else:
+                steps.extend((src, pending[src]) for src in reversed(chain))
+            for src in chain:
+                del pending[src]
+        return steps
+
+    @staticmethod
+    def _temporary_name(path):
+        head, tail = os.path.split(path)
+        number = 0
+        while True:
+            tmp = os.path.join(head, '.%s.rename-%d-%d' % (tail, os.getpid(), number))
+            if not os.path.lexists(tmp):
+                return tmp
+            number += 1
+
+    def describe(self):
+        """Returns the steps of the plan as human readable lines"""
+        lines = ['mkdir %s' % path for path in self.directories()]
+        lines.extend('mv %s -> %s' % step for step in self.steps())
+        return lines
+
+    def run(self):
+        """Carries out the plan.  Returns None or an error message"""
+        created = []
+        done = []
+        try:
+            for path in self.directories():
+                os.mkdir(path)
+                created.append(path)
+            for src, dst in self.steps():
+                os.rename(src, dst)
+                done.append((src, dst))
+        except OSError as ex:
+            for src, dst in reversed(done):
+                try:
+                    os.rename(dst, src)
+                except OSError:
+                    pass
+            for path in reversed(created):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass
+            return "%s: %s (all changes have been undone)" % (
+                ex.filename or '', ex.strerror or ex)
+        return None
+
+
 class bulkrename(Command):
-    """:bulkrename
+    """:bulkrename [-n]
 
     This command opens a list of selected files in an external editor.
-    After you edit and save the file, it will generate a shell script
-    which does bulk renaming according to the changes you did in the file.
+    After you edit and save the file, it will show the list of renames
+    that follow from your changes in an editor for you to review.  Delete
+    lines to skip renames, or clear the file to abort.  After you close
+    it, the files are renamed.
 
-    This shell script is opened in an editor for you to review.
-    After you close it, it will be executed.
+    With -n, the renaming steps are only shown in the pager.
     """
 
     def execute(self):
@@ -1129,80 +1994,180 @@ class bulkrename(Command):
         import sys
         import tempfile
         from ranger.container.file import File
-        from ranger.ext.shell_escape import shell_escape as esc
         py3 = sys.version_info[0] >= 3
+        dry_run = self.arg(1) == '-n'
 
-        # Create and edit the file list
-        filenames = [f.relative_path for f in self.fm.thistab.get_selection()]
-        with tempfile.NamedTemporaryFile(delete=False) as listfile:
-            listpath = listfile.name
+        def write(fobj, text):
             if py3:
-                listfile.write("\n".join(filenames).encode(
-                    encoding="utf-8", errors="surrogateescape"))
+                fobj.write(text.encode(encoding="utf-8", errors="surrogateescape"))
             else:
-                listfile.write("\n".join(filenames))
-        self.fm.execute_file([File(listpath)], app='editor')
-        with (open(listpath, 'r', encoding="utf-8", errors="surrogateescape") if
-              py3 else open(listpath, 'r')) as listfile:
-            new_filenames = listfile.read().split("\n")
-        os.unlink(listpath)
+                fobj.write(text)
+
+        def edit(text):
+            with tempfile.NamedTemporaryFile(delete=False) as tmpfile:
+                tmppath = tmpfile.name
+                write(tmpfile, text)
+            self.fm.execute_file([File(tmppath)], app='editor')
+            with (open(tmppath, 'r', encoding="utf-8", errors="surrogateescape") if
+                  py3 else open(tmppath, 'r')) as tmpfile:
+                text = tmpfile.read()
+            os.unlink(tmppath)
+            return text
+
+        # Create and edit the file list
+        filenames = [f.relative_path for f in self.fm.thistab.get_selection()]
+        new_filenames = edit("\n".join(filenames)).split("\n")
         if all(a == b for a, b in zip(filenames, new_filenames)):
             self.fm.notify("No renaming to be done!")
             return
+        renames = [(old, new) for old, new in zip(filenames, new_filenames)
+                   if old != new and new]
 
-        # Generate script
-        with tempfile.NamedTemporaryFile() as cmdfile:
-            script_lines = []
-            script_lines.append("# This file will be executed when you close"
-                                " the editor.")
-            script_lines.append("# Please double-check everything, clear the"
-                                " file to abort.")
-            new_dirs = []
-            for old, new in zip(filenames, new_filenames):
-                if old != new:
-                    basepath, _ = os.path.split(new)
-                    if (basepath and basepath not in new_dirs
-                            and not os.path.isdir(basepath)):
-                        script_lines.append("mkdir -vp -- {dir}".format(
-                            dir=esc(basepath)))
-                        new_dirs.append(basepath)
-                    script_lines.append("mv -vi -- {old} {new}".format(
-                        old=esc(old), new=esc(new)))
-            # Make sure not to forget the ending newline
-            script_content = "\n".join(script_lines) + "\n"
-            if py3:
-                cmdfile.write(script_content.encode(encoding="utf-8",
-                                                    errors="surrogateescape"))
+        # Let the user review the renames
+        def plan_of(renames):
+            path = self.fm.thisdir.path
+            return _RenamePlan([(os.path.join(path, old), os.path.join(path, new))
+                                for old, new in renames])
+
+        plan = plan_of(renames)
+        problems = plan.problems()
+        if dry_run:
+            pager = self.fm.ui.open_pager()
+            if problems:
+                pager.set_source(["Problems:"] + problems)
+            else:
+                pager.set_source(plan.describe())
+            return
+        if problems:
+            self.fm.notify("bulkrename: " + problems[0], bad=True)
+            return
+
+        lines = ["%s -> %s" % rename for rename in renames]
+        review = edit("# The files will be renamed when you close the editor.\n"
+                      "# Delete lines to skip renames, clear the file to abort.\n"
+                      + "\n".join(lines) + "\n")
+        # Plan lines may start with '#' themselves (e.g. "#notes# -> ..."),
+        # so only lines that are not part of the plan count as comments.
+        kept = set(line for line in review.split("\n") if line.strip())
+        if any(not line.startswith('#') for line in kept - set(lines)):
+            self.fm.notify("bulkrename: the plan can only be shortened, aborting",
+                           bad=True)
+            return
+        renames = [rename for rename, line in zip(renames, lines) if line in kept]
+        if not renames:
+            self.fm.notify("No renaming to be done!")
+            return
+
+        # Do the renaming.  Dropping a rename can leave another one
+        # without a free target, so check the shortened plan again.
+        plan = plan_of(renames)
+        problems = plan.problems()
+        if problems:
+            self.fm.notify("bulkrename: " + problems[0], bad=True)
+            return
+        error = plan.run()
+        if error:
+            self.fm.notify("bulkrename: " + error, bad=True)
+            return
+
+        # Move the tags, bookmarks and metadata along
+        _remap_paths(self.fm, plan.moves)
+
+
+class rename_pattern(Command):
+    """:rename_pattern [-FLAGS...] <regex> <template>
+
+    Renames all selected files by replacing the first match of <regex> in
+    their names with <template>, without opening an editor.
+
+    The template may refer to groups of the match like re.sub() does
+    (\\1, \\g<name>) and contain a counter: {n} is replaced with 1, 2, 3...
+    for the matching files in the order they are listed, and {n:3} pads it
+    with zeros to three digits.  The file extension is left untouched.
+    If any rename would overwrite a file, the conflicts are shown instead
+    and nothing is renamed.
+
+    Flags:
+     -a    Leave all extensions untouched, not only the last one
+     -e    Match and replace the extension too
+     -n    Only show what would be renamed
+    """
+
+    counter = re.compile(r'\{n(?::(\d+))?\}')
+
+    def execute(self):
+        flags, rest = self.parse_flags()
+        try:
+            pattern, template = rest.split(None, 1)
+            regex = re.compile(pattern)
+        except ValueError:
+            self.fm.notify("Syntax: rename_pattern [-FLAGS...] <regex> <template>", bad=True)
+            return
+        except re.error as ex:
+            self.fm.notify("rename_pattern: invalid regex: %s" % ex, bad=True)
+            return
+
+        moves = []
+        number = 0
+        for fobj in self.fm.thistab.get_selection():
+            name = fobj.basename
+            stem, ext = self._split_extension(name, fobj.is_directory, flags)
+            match = regex.search(stem)
+            if match is None:
+                continue
+            number += 1
+            try:
+                replacement = self._render(template, match, number)
+            except (re.error, IndexError) as ex:
+                self.fm.notify("rename_pattern: invalid template: %s" % ex, bad=True)
+                return
+            new_name = stem[:match.start()] + replacement + stem[match.end():] + ext
+            if new_name != name:
+                moves.append((fobj.path, os.path.join(os.path.dirname(fobj.path), new_name)))
+        if not moves:
+            self.fm.notify("No renaming to be done!")
+            return
+
+        plan = _RenamePlan(moves)
+        problems = plan.problems()
+        cwd = self.fm.thisdir.path
+        lines = ["%s -> %s" % (os.path.relpath(old, cwd), os.path.relpath(new, cwd))
+                 for old, new in plan.moves]
+        if problems or 'n' in flags:
+            pager = self.fm.ui.open_pager()
+            if problems:
+                pager.set_source(["Nothing was renamed because of these conflicts:"]
+                                 + problems + [""] + lines)
             else:
-                cmdfile.write(script_content)
-            cmdfile.flush()
-
-            # Open the script and let the user review it, then check if the
-            # script was modified by the user
-            self.fm.execute_file([File(cmdfile.name)], app='editor')
-            cmdfile.seek(0)
-            script_was_edited = (script_content != cmdfile.read())
-
-            # Do the renaming
-            self.fm.run(['/bin/sh', cmdfile.name], flags='w')
-
-        # Retag the files, but only if the script wasn't changed during review,
-        # because only then we know which are the source and destination files.
-        if not script_was_edited:
-            tags_changed = False
-            for old, new in zip(filenames, new_filenames):
-                if old != new:
-                    oldpath = self.fm.thisdir.path + '/' + old
-                    newpath = self.fm.thisdir.path + '/' + new
-                    if oldpath in self.fm.tags:
-                        old_tag = self.fm.tags.tags[oldpath]
-                        self.fm.tags.remove(oldpath)
-                        self.fm.tags.tags[newpath] = old_tag
-                        tags_changed = True
-            if tags_changed:
-                self.fm.tags.dump()
+                pager.set_source(lines)
+            return
+
+        error = plan.run()
+        if error:
+            self.fm.notify("rename_pattern: " + error, bad=True)
+            return
+        _remap_paths(self.fm, plan.moves)
+        self.fm.notify("Renamed %d files" % len(plan.moves))
+
+    @staticmethod
+    def _split_extension(name, is_directory, flags):
+        if 'e' in flags or is_directory or name.find('.') <= 0:
+            return name, ''
+        if 'a' in flags:
+            pos = re.search(r'[^.]+', name).end(0)
         else:
-            fm.notify("files have not been retagged")
+            pos = name.rindex('.')
+        return name[:pos], name[pos:]
+
+    def _render(self, template, match, number):
+        parts = []
+        pos = 0
+        for token in self.counter.finditer(template):
+            parts.append(match.expand(template[pos:token.start()]))
+            parts.append(str(number).zfill(int(token.group(1) or 0)))
+            pos = token.end()
+        parts.append(match.expand(template[pos:]))
+        return ''.join(parts)
 
 
 class relink(Command):
@@ -1434,6 +2399,94 @@ class pmap(map_):
     context = 'pager'
 
 
+def _casefold(string, normalize=False):
+    if normalize:
+        import unicodedata
+        string = unicodedata.normalize('NFKC', string)
+    try:
+        return string.casefold()
+    except AttributeError:  # Python 2
+        return string.lower()
+
+
+class _LiteralSearch(object):
+    """Stands in for a compiled regex when a scout pattern is a plain string.
+
+    It provides the `pattern' attribute and the search() method, which is all
+    that ranger uses of directory filters and of tab.last_search.  If a dict
+    of case folded names is given, the search ignores the case and looks up
+    the folded form of each name there instead of folding it again.
+    """
+
+    def __init__(self, pattern, folded_names=None, normalize=False):
+        self.pattern = pattern
+        self.folded_names = folded_names
+        self.normalize = normalize
+        if folded_names is None:
+            self.needle = pattern
+        else:
+            self.needle = _casefold(pattern, normalize)
+
+    def fold(self, string):
+        if self.folded_names is None:
+            return string
+        try:
+            return self.folded_names[string]
+        except KeyError:
+            return _casefold(string, self.normalize)
+
+    def search(self, string):
+        return self.needle in self.fold(string)
+
+
+class _SubsequenceSearch(_LiteralSearch):
+    """The counterpart of _LiteralSearch for scout's letter skipping mode.
+
+    The letters of the pattern have to appear in the name in the same order.
+    A single forward scan replaces the regex "a.*b.*c", which backtracks
+    badly on long names, and score() rates how well a name matches.
+    """
+
+    # Word starts count for less than in cd's completion, so that "rdme"
+    # prefers README over r_e_a_d_m_e
+    word_start_bonus = 4
+
+    def __init__(self, pattern, folded_names=None, normalize=False,
+                 anchor_start=False, anchor_end=False, invert=False):
+        # pylint: disable=too-many-arguments
+        super(_SubsequenceSearch, self).__init__(pattern, folded_names, normalize)
+        self.anchor_start = anchor_start
+        self.anchor_end = anchor_end
+        self.invert = invert
+
+    def _score(self, string):
+        needle = self.needle
+        if len(string) < len(needle):
+            return None
+        if needle and self.anchor_start and not string.startswith(needle[0]):
+            return None
+        if len(needle) == 1 and self.anchor_start and self.anchor_end:
+            # "^a$": the first letter is also the last one
+            if string != needle:
+                return None
+            return _fuzzy_score(needle, string, self.word_start_bonus)
+        if needle and self.anchor_end:
+            if not string.endswith(needle[-1]):
+                return None
+            needle = needle[:-1]
+            string = string[:-1]
+        return _fuzzy_score(needle, string, self.word_start_bonus)
+
+    def search(self, string):
+        return (self._score(self.fold(string)) is None) == self.invert
+
+    def score(self, string):
+        """Returns a score for how well string matches, or None"""
+        if self.invert:
+            return 0 if self.search(string) else None
+        return self._score(self.fold(string))
+
+
 class scout(Command):
     """:scout [-FLAGS...] <pattern>
 
@@ -1475,6 +2528,9 @@ class scout(Command):
     INVERT        = 'v'
     # pylint: enable=bad-whitespace
 
+    # Apply unicode normalization (NFKC) when ignoring the case
+    normalize_unicode = False
+
     def __init__(self, *args, **kwargs):
         super(scout, self).__init__(*args, **kwargs)
         self._regex = None
@@ -1525,7 +2581,18 @@ class scout(Command):
         if self.quickly_executed and thisdir != self.fm.thisdir and pattern != "..":
             self.fm.block_input(0.5)
 
+    # Results of the as-you-type filter passes of the previous keystrokes,
+    # a stack of (pattern, files) tuples.  See _refilter_as_you_type().
+    _filter_results = []
+    _filter_results_key = None
+    # Case folded names of recently searched directories, by directory
+    _folded_names = {}
+    # Indices of all matches in the current directory, see _cycle_matches()
+    _match_positions = None
+    _match_positions_key = None
+
     def cancel(self):
+        del scout._filter_results[:]
         self.fm.thisdir.temporary_filter = None
         self.fm.thisdir.refilter()
 
@@ -1535,12 +2602,67 @@ class scout(Command):
             self.fm.thisdir.temporary_filter = self._build_regex()
         if self.PERM_FILTER in self.flags and asyoutype:
             self.fm.thisdir.filter = self._build_regex()
-        if self.FILTER in self.flags or self.PERM_FILTER in self.flags:
+        if self.FILTER in self.flags or (self.PERM_FILTER in self.flags and asyoutype):
+            self._refilter_as_you_type()
+        elif self.PERM_FILTER in self.flags:
             self.fm.thisdir.refilter()
         if self._count(move=asyoutype) == 1 and self.AUTO_OPEN in self.flags:
             return True
         return False
 
+    def _is_narrowing(self, old_pattern):
+        """Can only files that matched old_pattern match the current pattern?"""
+        if self.SM_REGEX in self.flags or self.INVERT in self.flags:
+            return False
+        return (self.pattern.startswith(old_pattern) and not old_pattern.endswith('$')) \
+            or old_pattern == '.'
+
+    def _refilter_as_you_type(self):
+        """Like thisdir.refilter(), but reuses the results of earlier keystrokes.
+
+        When the pattern was extended, only the files that were left after the
+        previous keystroke are tested again.  When characters were deleted, the
+        result that was cached for the shorter pattern is restored.
+        """
+        thisdir = self.fm.thisdir
+        results = scout._filter_results
+        key = (thisdir.path, id(thisdir.files_all), self.flags, thisdir.last_update_time)
+        if scout._filter_results_key != key:
+            del results[:]
+
+        while results and not self._is_narrowing(results[-1][0]) \
+                and results[-1][0] != self.pattern:
+            results.pop()
+
+        if not results:
+            thisdir.refilter()
+        else:
+            old_pattern, old_files = results[-1]
+            if old_pattern == self.pattern:
+                files = old_files
+            else:
+                search = self._build_regex().search
+                files = [fobj for fobj in old_files if search(fobj.basename)]
+            self._set_filtered_files(thisdir, files)
+
+        if thisdir.files is not None and (not results or results[-1][0] != self.pattern):
+            results.append((self.pattern, thisdir.files))
+        scout._filter_results_key = (thisdir.path, id(thisdir.files_all), self.flags,
+                                     thisdir.last_update_time)
+
+    @staticmethod
+    def _set_filtered_files(thisdir, files):
+        # Mirrors the end of Directory.refilter()
+        from time import time
+        thisdir.last_update_time = time()
+        thisdir.files = list(files)
+        if thisdir.files and not thisdir.pointed_obj:
+            thisdir.pointed_obj = thisdir.files[0]
+        elif not thisdir.files:
+            thisdir.content_loaded = False
+            thisdir.pointed_obj = None
+        thisdir.move_to_obj(thisdir.pointed_obj)
+
     def tab(self, tabnum):
         self._count(move=True, offset=tabnum)
 
@@ -1555,6 +2677,16 @@ class scout(Command):
         if pattern == ".":
             return re.compile("")
 
+        # Plain strings and letter skipping are done without the overhead
+        # of a regex
+        if self.SM_LETTERSKIP in flags and self.SM_REGEX not in flags \
+                and self.SM_GLOB not in flags:
+            self._regex = self._build_subsequence_search()
+        else:
+            self._regex = self._build_literal_search()
+        if self._regex is not None:
+            return self._regex
+
         # Handle carets at start and dollar signs at end separately
         if pattern.startswith('^'):
             pattern = pattern[1:]
@@ -1592,8 +2724,53 @@ class scout(Command):
             self._regex = re.compile("")
         return self._regex
 
+    def _build_literal_search(self):
+        flags = self.flags
+        pattern = self.pattern
+
+        if self.SM_REGEX in flags or self.SM_LETTERSKIP in flags or self.INVERT in flags:
+            return None
+        if pattern.startswith('^') or pattern.endswith('$'):
+            return None
+        if self.SM_GLOB in flags and ('*' in pattern or '?' in pattern):
+            return None
+
+        if self.IGNORE_CASE in flags or self.SMART_CASE in flags and \
+                pattern.islower():
+            return _LiteralSearch(pattern, self._get_folded_names(), self.normalize_unicode)
+        return _LiteralSearch(pattern)
+
+    def _build_subsequence_search(self):
+        pattern = self.pattern
+        anchor_start = pattern.startswith('^')
+        if anchor_start:
+            pattern = pattern[1:]
+        anchor_end = pattern.endswith('$')
+        if anchor_end:
+            pattern = pattern[:-1]
+
+        if self.IGNORE_CASE in self.flags or self.SMART_CASE in self.flags and \
+                pattern.islower():
+            return _SubsequenceSearch(pattern, self._get_folded_names(), self.normalize_unicode,
+                                      anchor_start, anchor_end, self.INVERT in self.flags)
+        return _SubsequenceSearch(pattern, None, False,
+                                  anchor_start, anchor_end, self.INVERT in self.flags)
+
+    def _get_folded_names(self):
+        thisdir = self.fm.thisdir
+        key = (thisdir.path, id(thisdir.files_all), self.normalize_unicode)
+        try:
+            return scout._folded_names[key]
+        except KeyError:
+            pass
+        if len(scout._folded_names) >= 16:
+            scout._folded_names.clear()
+        names = scout._folded_names[key] = dict(
+            (fobj.relative_path, _casefold(fobj.relative_path, self.normalize_unicode))
+            for fobj in thisdir.files_all or ())
+        return names
+
     def _count(self, move=False, offset=0):
-        count = 0
         cwd = self.fm.thisdir
         pattern = self.pattern
 
@@ -1604,22 +2781,75 @@ class scout(Command):
         if pattern == '..':
             return 1
 
-        deq = deque(cwd.files)
-        deq.rotate(-cwd.pointer - offset)
-        i = offset
         regex = self._build_regex()
-        for fsobj in deq:
-            if regex.search(fsobj.relative_path):
+        if move and not offset and hasattr(regex, 'score'):
+            return self._move_to_best_match(regex)
+        if move and offset:
+            return self._cycle_matches(regex, offset)
+
+        files = cwd.files
+        length = len(files)
+        pointer = cwd.pointer
+        count = 0
+        for i in range(length):
+            index = (pointer + offset + i) % length
+            if regex.search(files[index].relative_path):
                 count += 1
                 if move and count == 1:
-                    cwd.move(to=(cwd.pointer + i) % len(cwd.files))
+                    cwd.move(to=index)
                     self.fm.thisfile = cwd.pointed_obj
-            if count > 1:
-                return count
-            i += 1
+                if count > 1:
+                    return count
 
         return count == 1
 
+    def _cycle_matches(self, regex, offset):
+        """Moves to the offset'th match after (or before) the cursor
+
+        The positions of all matches are computed on the first <TAB> and
+        reused as long as the pattern and the file list stay the same.
+        """
+        from bisect import bisect_left, bisect_right
+
+        cwd = self.fm.thisdir
+        key = (self.pattern, self.flags, cwd.path, id(cwd.files), cwd.last_update_time)
+        if scout._match_positions_key != key:
+            scout._match_positions = [i for i, fsobj in enumerate(cwd.files)
+                                      if regex.search(fsobj.relative_path)]
+            scout._match_positions_key = key
+
+        positions = scout._match_positions
+        if not positions:
+            return 0
+        if offset > 0:
+            index = bisect_right(positions, cwd.pointer) + offset - 1
+        else:
+            index = bisect_left(positions, cwd.pointer) + offset
+        cwd.move(to=positions[index % len(positions)])
+        self.fm.thisfile = cwd.pointed_obj
+        return len(positions)
+
+    def _move_to_best_match(self, search):
+        """Moves to the file with the highest score, returns the match count
+
+        Of equally good matches, the first one after the cursor wins.
+        """
+        cwd = self.fm.thisdir
+        length = len(cwd.files)
+        count = 0
+        best_score = best_index = None
+        for i in range(length):
+            index = (cwd.pointer + i) % length
+            score = search.score(cwd.files[index].relative_path)
+            if score is not None:
+                count += 1
+                if best_score is None or score > best_score:
+                    best_score, best_index = score, index
+        if best_index is not None:
+            cwd.move(to=best_index)
+            self.fm.thisfile = cwd.pointed_obj
+        return count
+
 
 class narrow(Command):
     """
@@ -1657,6 +2887,181 @@ class filter_inode_type(Command):
         self.fm.thisdir.refilter()
 
 
+def _all_of(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+    first, rest = predicates[0], _all_of(predicates[1:])
+    return lambda fobj: first(fobj) and rest(fobj)
+
+
+def _any_of(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+    first, rest = predicates[0], _any_of(predicates[1:])
+    return lambda fobj: first(fobj) or rest(fobj)
+
+
+class _FilterPipeline(object):  # pylint: disable=too-many-instance-attributes
+    """A filter stack compiled into a single predicate.
+
+    Directory.refilter() calls every entry of Directory.filter_stack for
+    every file.  :filter_stack keeps the actual stack in `stack' and puts
+    only this object into Directory.filter_stack.  It is compiled once per
+    change of the stack: the filters are ordered by cost, and/or/not
+    short-circuit without the generators of the combinator classes, and all
+    mime filters share the guessed type of a file.
+
+    The first call after a (re)load of the directory evaluates the stack for
+    the whole listing at once.  The results of the leaf filters are kept as
+    sets of file indices and survive rebuilding the pipeline, so rotating or
+    decomposing the stack only recombines them.  Combinators only pass on
+    the files that are still undecided, so leaves are evaluated lazily.
+    """
+    # Listing snapshots used for the file indices, by directory path:
+    # (files_all, length, snapshot, {id(file): index})
+    _listings = {}
+    # Results of leaf filters, by id(filter):
+    # [filter, snapshot, evaluated indices, matching indices]
+    _leaf_results = {}
+
+    def __init__(self, directory, stack):
+        self.directory = directory
+        self.stack = list(stack)
+        self._mimetypes = {}
+        self._accepted = None
+        self._accepted_snapshot = None
+        self.tree = self._compile_all(self.stack)
+        self._forget_other_leaves()
+
+    def __call__(self, fobj):
+        listing = self._get_listing()
+        if listing is None:
+            return self.tree[-1](fobj)
+        _, _, snapshot, indices = listing
+        if self._accepted_snapshot is not snapshot:
+            self._accepted = self._evaluate(
+                self.tree, set(range(len(snapshot))), snapshot)
+            self._accepted_snapshot = snapshot
+        try:
+            return indices[id(fobj)] in self._accepted
+        except KeyError:
+            return self.tree[-1](fobj)
+
+    def __str__(self):
+        return " and ".join(map(str, self.stack))
+
+    @staticmethod
+    def forget():
+        """Drops all cached filter results"""
+        _FilterPipeline._listings.clear()
+        _FilterPipeline._leaf_results.clear()
+
+    def _get_listing(self):
+        files = self.directory.files_all
+        if files is None:
+            return None
+        listing = _FilterPipeline._listings.get(self.directory.path)
+        if listing is None or listing[0] is not files or listing[1] != len(files):
+            snapshot = list(files)
+            listing = _FilterPipeline._listings[self.directory.path] = (
+                files, len(files), snapshot,
+                dict((id(fobj), i) for i, fobj in enumerate(snapshot)))
+        return listing
+
+    def _forget_other_leaves(self):
+        leaves = set()
+        nodes = [self.tree]
+        while nodes:
+            node = nodes.pop()
+            if node[1] == 'leaf':
+                leaves.add(id(node[2]))
+            nodes.extend(node[3])
+        for key in list(_FilterPipeline._leaf_results):
+            if key not in leaves:
+                del _FilterPipeline._leaf_results[key]
+
+    def _evaluate(self, node, candidates, snapshot):
+        """Returns the subset of the candidate indices that node accepts"""
+        _, kind, filt, children, predicate = node
+        if kind == 'and':
+            for child in children:
+                if not candidates:
+                    break
+                candidates = self._evaluate(child, candidates, snapshot)
+            return candidates
+        if kind == 'or':
+            accepted = set()
+            for child in children:
+                if not candidates:
+                    break
+                matched = self._evaluate(child, candidates, snapshot)
+                accepted |= matched
+                candidates = candidates - matched
+            return accepted
+        if kind == 'not':
+            return candidates - self._evaluate(children[0], candidates, snapshot)
+
+        result = _FilterPipeline._leaf_results.get(id(filt))
+        if result is None or result[0] is not filt or result[1] is not snapshot:
+            result = _FilterPipeline._leaf_results[id(filt)] = [filt, snapshot, set(), set()]
+        todo = candidates - result[2]
+        if todo:
+            result[3].update(i for i in todo if predicate(snapshot[i]))
+            result[2] |= todo
+        return candidates & result[3]
+
+    def _mimetype(self, fobj):
+        import mimetypes
+        try:
+            return self._mimetypes[fobj.relative_path]
+        except KeyError:
+            mimetype = self._mimetypes[fobj.relative_path] = \
+                mimetypes.guess_type(fobj.relative_path)[0]
+            return mimetype
+
+    def _compile_all(self, filters):
+        children = sorted((self._compile(filt) for filt in filters),
+                          key=lambda node: node[0])
+        return (sum(node[0] for node in children), 'and', None, children,
+                _all_of([node[-1] for node in children]))
+
+    def _compile(self, filt):
+        """Returns a node (cost, kind, filter, children, predicate)"""
+        from ranger.core.filter_stack import (
+            AndFilter, DuplicateFilter, MimeFilter, NameFilter, NotFilter,
+            OrFilter, TypeFilter, UniqueFilter)
+
+        if isinstance(filt, TypeFilter):
+            return 0, 'leaf', filt, [], TypeFilter.type_to_function[filt.filetype]
+        if isinstance(filt, (DuplicateFilter, UniqueFilter)):
+            return 1, 'leaf', filt, [], filt
+        if isinstance(filt, NameFilter):
+            name_search = filt.regex.search
+            return 1, 'leaf', filt, [], lambda fobj: name_search(fobj.relative_path)
+        if isinstance(filt, MimeFilter):
+            mime_search = filt.regex.search
+            mimetype = self._mimetype
+
+            def mime_predicate(fobj):
+                mime = mimetype(fobj)
+                return mime is not None and mime_search(mime)
+            return 2, 'leaf', filt, [], mime_predicate
+        if isinstance(filt, NotFilter):
+            child = self._compile(filt.subfilter)
+            predicate = child[-1]
+            return child[0], 'not', filt, [child], lambda fobj: not predicate(fobj)
+        if isinstance(filt, AndFilter):
+            node = self._compile_all(filt.subfilters)
+            return node[0], 'and', filt, node[3], node[4]
+        if isinstance(filt, OrFilter):
+            children = sorted((self._compile(sub) for sub in filt.subfilters),
+                              key=lambda node: node[0])
+            return (sum(node[0] for node in children), 'or', filt, children,
+                    _any_of([node[-1] for node in children]))
+        # hash filters and anything unknown are expensive black boxes
+        return 10, 'leaf', filt, [], filt
+
+
 class filter_stack(Command):
     """
     :filter_stack ...
@@ -1674,30 +3079,28 @@ class filter_stack(Command):
         from ranger.core.filter_stack import SIMPLE_FILTERS, FILTER_COMBINATORS
 
         subcommand = self.arg(1)
+        stack = self._get_stack()
 
         if subcommand == "add":
             try:
-                self.fm.thisdir.filter_stack.append(
+                stack.append(
                     SIMPLE_FILTERS[self.arg(2)](self.rest(3))
                 )
             except KeyError:
-                FILTER_COMBINATORS[self.arg(2)](self.fm.thisdir.filter_stack)
+                FILTER_COMBINATORS[self.arg(2)](stack)
         elif subcommand == "pop":
-            self.fm.thisdir.filter_stack.pop()
+            stack.pop()
         elif subcommand == "decompose":
-            inner_filters = self.fm.thisdir.filter_stack.pop().decompose()
+            inner_filters = stack.pop().decompose()
             if inner_filters:
-                self.fm.thisdir.filter_stack.extend(inner_filters)
+                stack.extend(inner_filters)
         elif subcommand == "clear":
-            self.fm.thisdir.filter_stack = []
+            stack = []
         elif subcommand == "rotate":
             rotate_by = int(self.arg(2) or self.quantifier or 1)
-            self.fm.thisdir.filter_stack = (
-                self.fm.thisdir.filter_stack[-rotate_by:]
-                + self.fm.thisdir.filter_stack[:-rotate_by]
-            )
+            stack = stack[-rotate_by:] + stack[:-rotate_by]
         elif subcommand == "show":
-            stack = list(map(str, self.fm.thisdir.filter_stack))
+            stack = list(map(str, stack))
             pager = self.fm.ui.open_pager()
             pager.set_source(["Filter stack: "] + stack)
             pager.move(to=100, percentage=True)
@@ -1709,21 +3112,874 @@ class filter_stack(Command):
             )
             return
 
+        if stack:
+            self.fm.thisdir.filter_stack = [_FilterPipeline(self.fm.thisdir, stack)]
+        else:
+            self.fm.thisdir.filter_stack = []
+            _FilterPipeline.forget()
         self.fm.thisdir.refilter()
 
+    def _get_stack(self):
+        current = self.fm.thisdir.filter_stack
+        if len(current) == 1 and isinstance(current[0], _FilterPipeline):
+            return list(current[0].stack)
+        return list(current)
+
+
+class _TrigramIndex(object):
+    """A persistent index of the byte trigrams of the files below a directory
+
+    The index is an SQLite database with the [mtime, size] of every file
+    and, for every trigram, the posting list of the ids of the files that
+    contain it.  A file that lacks a trigram of some literal part of a
+    pattern cannot match it, so it doesn't need to be read.  A query only
+    reads the posting lists of the pattern's trigrams.
+
+    New postings are collected in memory and merged into the posting
+    lists once per save(), so saving writes only the trigrams of the files
+    that were (re)indexed.  A file that changes gets a new id, which
+    leaves its old postings pointing nowhere; they are cleaned up once
+    they make up half of the index.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(
+            'CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' path TEXT UNIQUE, mtime REAL, size INTEGER, grams INTEGER);'
+            'CREATE TABLE IF NOT EXISTS postings (gram INTEGER PRIMARY KEY, files BLOB);'
+            'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);')
+        self.new_postings = {}
+        self._candidates = {}
+
+    @staticmethod
+    def trigrams(data):
+        """Returns the set of distinct trigrams of the bytes `data' as integers"""
+        from struct import unpack
+
+        grams = set(data[i:i + 3] for i in range(len(data) - 2))
+        return set(unpack('>I', b'\0' + gram)[0] for gram in grams)
+
+    @staticmethod
+    def required(regex):
+        """Returns the trigrams that every match of a bytes regex contains
+
+        These are the trigrams of the runs of literal characters at the
+        top level of the pattern, which any match has to include.
+        """
+        try:
+            from re import _parser as sre_parse  # pylint: disable=no-name-in-module
+        except ImportError:
+            import sre_parse  # pylint: disable=deprecated-module
+
+        if regex.flags & re.IGNORECASE:
+            return set()
+        try:
+            parsed = list(sre_parse.parse(regex.pattern, regex.flags))
+        except Exception:  # pylint: disable=broad-except
+            return set()
+        grams = set()
+        run = bytearray()
+        for op, arg in parsed + [(None, None)]:
+            if op == sre_parse.LITERAL:
+                run.append(arg)
+                continue
+            grams.update(_TrigramIndex.trigrams(bytes(run)))
+            run = bytearray()
+        return grams
+
+    @staticmethod
+    def _ids(blob):
+        from array import array
+
+        ids = array('I')
+        if blob:
+            ids.frombytes(bytes(blob))
+        return ids
+
+    def candidates(self, required):
+        """Returns the ids of the indexed files that contain all required trigrams"""
+        key = frozenset(required)
+        result = self._candidates.get(key)
+        if result is None:
+            for gram in required:
+                row = self.db.execute('SELECT files FROM postings WHERE gram = ?',
+                                      (gram,)).fetchone()
+                ids = set(self._ids(row[0])) if row else set()
+                result = ids if result is None else result & ids
+                if not result:
+                    break
+            self._candidates[key] = result
+        return result
+
+    def may_match(self, path, stat, required):
+        """Whether the file might contain all required trigrams
+
+        Files that are not indexed or changed since might.
+        """
+        if not required:
+            return True
+        entry = self.db.execute('SELECT id, mtime, size FROM files WHERE path = ?',
+                                (path,)).fetchone()
+        if entry is None or entry[1] != stat.st_mtime or entry[2] != stat.st_size:
+            return True
+        return entry[0] in self.candidates(required)
+
+    def update(self, path, stat, grams):
+        from array import array
+
+        self._forget('path = ?', [(path,)])
+        file_id = self.db.execute(
+            'INSERT INTO files (path, mtime, size, grams) VALUES (?, ?, ?, ?)',
+            (path, stat.st_mtime, stat.st_size, len(grams))).lastrowid
+        for gram in grams:
+            ids = self.new_postings.get(gram)
+            if ids is None:
+                ids = self.new_postings[gram] = array('I')
+            ids.append(file_id)
+
+    def prune(self, paths):
+        """Forgets all files that are not in `paths'"""
+        self._forget('id = ?', [(file_id,) for file_id, path
+                                in self.db.execute('SELECT id, path FROM files')
+                                if path not in paths])
+
+    def _forget(self, where, params):
+        """Removes files; their postings are left behind as garbage"""
+        garbage = 0
+        for param in params:
+            row = self.db.execute('SELECT grams FROM files WHERE ' + where, param).fetchone()
+            if row is not None:
+                garbage += row[0]
+                self.db.execute('DELETE FROM files WHERE ' + where, param)
+        if garbage:
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (\'garbage\', ?)',
+                            (self._garbage() + garbage,))
+
+    def _garbage(self):
+        row = self.db.execute('SELECT value FROM meta WHERE key = \'garbage\'').fetchone()
+        return row[0] if row else 0
+
+    def save(self):
+        import sqlite3
+
+        select = 'SELECT files FROM postings WHERE gram = ?'
+        try:
+            for gram in sorted(self.new_postings):
+                row = self.db.execute(select, (gram,)).fetchone()
+                ids = self._ids(row[0] if row else None) + self.new_postings[gram]
+                self.db.execute('INSERT OR REPLACE INTO postings VALUES (?, ?)',
+                                (gram, ids.tobytes()))
+            self.new_postings = {}
+            live = self.db.execute('SELECT COALESCE(SUM(grams), 0) FROM files').fetchone()[0]
+            if self._garbage() > max(live, 1 << 16):
+                self._compact()
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            self.new_postings = {}
+        self._candidates.clear()
+
+    def _compact(self):
+        """Drops the postings of files that have been forgotten"""
+        from array import array
+
+        live = set(row[0] for row in self.db.execute('SELECT id FROM files'))
+        rows = self.db.execute('SELECT gram, files FROM postings').fetchall()
+        for gram, blob in rows:
+            ids = array('I', (file_id for file_id in self._ids(blob) if file_id in live))
+            if ids:
+                self.db.execute('UPDATE postings SET files = ? WHERE gram = ?',
+                                (ids.tobytes(), gram))
+            else:
+                self.db.execute('DELETE FROM postings WHERE gram = ?', (gram,))
+        self.db.execute('DELETE FROM meta WHERE key = \'garbage\'')
+
+
+class _ContentSearch(Loadable):
+    """Searches the contents of files in worker threads
+
+    The loader walks the given paths a few files at a time and hands them
+    to `workers' threads, which report every matching line as a tuple
+    (path, line number, column, text).  The matches are passed to
+    `on_results' in batches from the main thread, so they show up while
+    the search is still running.  Binary files are skipped and files
+    larger than `mmap_threshold' are mapped instead of read.
+
+    If `index_for' is given, it is called with every searched directory
+    and may return a _TrigramIndex for it.  Files the index rules out are
+    not read, and all other files of up to `mmap_threshold' bytes are
+    (re)indexed while they are searched.
+    """
+
+    mmap_threshold = 1 << 20
+    binary_probe = 8192
+    queue_limit = 1024
+
+    def __init__(self, paths, regex, on_results, on_finished=None,
+                 workers=8, max_results=None, hidden=None, index_for=None):
+        # pylint: disable=too-many-arguments
+        Loadable.__init__(self, self.generate(), 'Searching files')
+        self.paths = paths
+        self.regex = regex
+        self.on_results = on_results
+        self.on_finished = on_finished
+        self.workers = workers
+        self.max_results = max_results
+        self.hidden = hidden
+        self.index_for = index_for
+        self.required = _TrigramIndex.required(regex) if index_for else set()
+        self.results = []
+        self.queued = 0
+        self.searched = 0
+        self.skipped = 0
+        self.truncated = False
+        self.cancelled = False
+        self._stop = None
+
+    def cancel(self):
+        if self._stop is not None:
+            self._stop.set()
+
+    def destroy(self):
+        # Removed from the taskview: wrap up like a finished search, so
+        # the indexes are saved and on_finished is called
+        self.cancel()
+        self.cancelled = True
+        generator, self.load_generator = self.load_generator, None
+        if self._stop is None:
+            if self.on_finished is not None:
+                self.on_finished(self)
+        elif generator is not None:
+            generator.close()
+
+    def generate(self):  # pylint: disable=too-many-branches
+        import threading
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue  # pylint: disable=import-error
+
+        todo = queue.Queue()
+        done = queue.Queue()
+        self._stop = stop = threading.Event()
+
+        def work():
+            while True:
+                item = todo.get()
+                if item is None or stop.is_set():
+                    return
+                try:
+                    done.put(self._search_file(*item))
+                except (IOError, OSError, ValueError):
+                    done.put(([], None))
+
+        threads = []
+        for _ in range(self.workers):
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        indexes = []
+        walker = self._walk(indexes)
+        walking = True
+        try:
+            while (walking or self.searched < self.queued) and not stop.is_set():
+                while walking and self.queued - self.searched < self.queue_limit:
+                    try:
+                        todo.put(next(walker))
+                    except StopIteration:
+                        walking = False
+                        break
+                    self.queued += 1
+                    if self.queued % 64 == 0:
+                        break
+
+                batch = []
+                timeout = None if walking else 0.02
+                while True:
+                    try:
+                        if timeout is None:
+                            matches, update = done.get_nowait()
+                        else:
+                            matches, update = done.get(timeout=timeout)
+                            timeout = None
+                    except queue.Empty:
+                        break
+                    self.searched += 1
+                    batch.extend(matches)
+                    if update is not None:
+                        update[0].update(*update[1:])
+
+                if batch:
+                    if self.max_results is not None and \
+                            len(self.results) + len(batch) >= self.max_results:
+                        del batch[self.max_results - len(self.results):]
+                        self.truncated = True
+                    self.results.extend(batch)
+                    self.on_results(batch)
+                    if self.truncated:
+                        break
+                self.percent = 100 * self.searched // max(1, self.queued)
+                yield
+        finally:
+            stop.set()
+            for _ in threads:
+                todo.put(None)
+            for index in indexes:
+                index.save()
+            if self.on_finished is not None:
+                self.on_finished(self)
+
+    def _walk(self, indexes):
+        """Yields (path, index) for every file that needs to be searched"""
+        hidden = self.hidden
+        for path in self.paths:
+            if not os.path.isdir(path):
+                yield path, None
+                continue
+            index = self.index_for(path) if self.index_for else None
+            if index is not None:
+                indexes.append(index)
+            seen = set()
+            for dirpath, dirnames, filenames in os.walk(path):
+                if hidden is not None:
+                    dirnames[:] = [name for name in dirnames if not hidden.search(name)]
+                for name in filenames:
+                    if hidden is not None and hidden.search(name):
+                        continue
+                    fpath = os.path.join(dirpath, name)
+                    if index is not None:
+                        seen.add(fpath)
+                        try:
+                            stat = os.stat(fpath)
+                        except OSError:
+                            continue
+                        if not index.may_match(fpath, stat, self.required):
+                            self.skipped += 1
+                            continue
+                    yield fpath, index
+            if index is not None:
+                index.prune(seen)
+
+    def _search_file(self, path, index=None):
+        """Returns the matches in a file and the update for its index entry"""
+        import mmap
+
+        with open(path, 'rb') as fobj:
+            head = fobj.read(self.binary_probe)
+            binary = b'\0' in head
+            stat = os.fstat(fobj.fileno())
+            if stat.st_size > self.mmap_threshold:
+                if binary:
+                    return [], None
+                data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    return self._find_lines(path, data), None
+                finally:
+                    data.close()
+            data = b'' if binary else head + fobj.read()
+        update = None
+        if index is not None:
+            update = (index, path, stat, _TrigramIndex.trigrams(data))
+        return self._find_lines(path, data), update
+
+    def _find_lines(self, path, data):
+        """Return one match per matching line of `data'"""
+        search = self.regex.search
+        matches = []
+        lineno = 1
+        counted = 0
+        pos = 0
+        while True:
+            match = search(data, pos)
+            if match is None:
+                break
+            start = match.start()
+            line_start = data.rfind(b'\n', 0, start) + 1
+            if line_start == start == len(data):
+                break
+            line_end = data.find(b'\n', start)
+            lineno += data[counted:line_start].count(b'\n')
+            counted = line_start
+            text = data[line_start:len(data) if line_end < 0 else line_end]
+            matches.append((path, lineno, start - line_start + 1,
+                            text.decode('utf-8', 'replace')))
+            if line_end < 0:
+                break
+            pos = line_end + 1
+        return matches
+
+
+class _GrepListing(object):
+    """Shows the files matched by a _ContentSearch in place of a directory
+
+    The directory's entries are replaced with one entry per file that has
+    matches, in the order in which they are found.  Every entry keeps its
+    matches as a list of (line, column, text) in `grep_hits' and shows the
+    position of the first one.  Loading the directory again, e.g. with
+    :flat 0 or :reload_cwd, brings the real listing back.
+    """
+
+    def __init__(self, fm, directory):
+        self.fm = fm
+        self.directory = directory
+        self.files_all = []
+        self.items = {}
+
+    def start(self):
+        directory = self.directory
+        _FlatStream.stop(directory)
+        directory.unload()
+        # Keeps refilter() from loading the real listing while it's empty
+        directory.loading = True
+        directory.load_content_if_outdated = self._load_content_if_outdated
+        directory._clear_marked_items()  # pylint: disable=protected-access
+        directory.files_all = self.files_all
+        directory.filenames = []
+        directory.cycle_list = None
+        directory.refilter()
+
+    def is_current(self):
+        return self.directory.files_all is self.files_all
+
+    def _load_content_if_outdated(self, *args, **kwargs):
+        if self.is_current():
+            return False
+        _FlatStream.stop(self.directory)
+        return self.directory.load_content_if_outdated(*args, **kwargs)
+
+    def add(self, batch):
+        from time import time
+        from ranger.container.file import File
+
+        directory = self.directory
+        for path, line, column, text in batch:
+            item = self.items.get(path)
+            if item is None:
+                item = File(path, path_is_abs=True, basename_is_rel_to=directory.path)
+                item.load()
+                item.grep_hits = []
+                self.items[path] = item
+                self.files_all.append(item)
+                directory.filenames.append(path)
+            item.grep_hits.append((line, column, text))
+            item.infostring = ' %d:%d' % item.grep_hits[0][:2]
+            if len(item.grep_hits) > 1:
+                item.infostring += ' +%d' % (len(item.grep_hits) - 1)
+        directory.refilter()
+        if directory.files:
+            directory.content_loaded = True
+        directory.last_update_time = time()
+
+    def finish(self):
+        if self.is_current():
+            self.directory.loading = False
+            self.directory.content_loaded = True
+
 
 class grep(Command):
-    """:grep <string>
+    """:grep [-l] <string>
 
     Looks for a string in all marked files or directories
+
+    The string is a Python regular expression (it is matched literally if
+    it isn't a valid one).  The search runs in the background and matching
+    lines show up in the pager as they are found; closing the pager stops
+    it.  Binary files are skipped, and so are hidden files unless they are
+    shown.  At most `max_results' lines are listed.
+
+    With -l, the matching files replace the current directory's entries
+    instead, each showing the line and column of its first match.  Use
+    :grep_open to jump to the matches of a file.
+
+    With `use_index', a trigram index of every searched directory is kept
+    in ranger's data directory and updated as files change, so repeated
+    searches only read the files that can contain the literal parts of
+    the pattern.
     """
 
+    workers = 8
+    max_results = 10000
+    use_index = True
+    index_dirname = 'grep_index'
+    _indexes = {}
+
     def execute(self):
-        if self.rest(1):
-            action = ['grep', '--line-number']
-            action.extend(['-e', self.rest(1), '-r'])
-            action.extend(f.path for f in self.fm.thistab.get_selection())
-            self.fm.execute_command(action, flags='p')
+        listing = self.arg(1) == '-l'
+        pattern = self.rest(2 if listing else 1)
+        if not pattern:
+            return
+        if not isinstance(pattern, bytes):
+            pattern = pattern.encode('utf-8')
+        try:
+            regex = re.compile(pattern, re.MULTILINE)
+        except re.error:
+            regex = re.compile(re.escape(pattern), re.MULTILINE)
+        hidden = None
+        if not self.fm.settings.show_hidden and self.fm.settings.hidden_filter:
+            hidden = re.compile(self.fm.settings.hidden_filter)
+        paths = [f.path for f in self.fm.thistab.get_selection()]
+
+        if listing:
+            view = _GrepListing(self.fm, self.fm.thisdir)
+            view.start()
+
+            def on_results(batch):
+                if not view.is_current():
+                    search.cancel()
+                    return
+                view.add(batch)
+        else:
+            pager = self.fm.ui.open_pager()
+            lines = []
+            pager.set_source(lines)
+
+            def on_results(batch):
+                if not pager.visible or pager.source is not lines:
+                    search.cancel()
+                    return
+                new_lines = ['%s:%d:%s' % (path, lineno, text)
+                             for path, lineno, _, text in batch]
+                lines.extend(new_lines)
+                pager.max_width = max(pager.max_width, max(len(line) for line in new_lines))
+                pager.need_redraw = True
+
+        def on_finished(search):
+            if listing:
+                view.finish()
+            if search.truncated or search.cancelled:
+                self.fm.notify("grep: stopped after %d matches" % len(search.results),
+                               bad=True)
+            else:
+                self.fm.notify("grep: %d matches in %d files (%d ruled out by the index)" % (
+                    len(search.results), search.searched, search.skipped))
+
+        search = _ContentSearch(paths, regex,
+                                on_results, on_finished, workers=self.workers,
+                                max_results=self.max_results, hidden=hidden,
+                                index_for=self._get_index if self.use_index else None)
+        self.fm.loader.add(search)
+
+    def _get_index(self, path):
+        from hashlib import sha1
+
+        index = grep._indexes.get(path)
+        if index is None:
+            dirname = self.fm.datapath(self.index_dirname)
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    return None
+            name = sha1(path.encode('utf-8', 'surrogateescape')).hexdigest() + '.db'
+            try:
+                import sqlite3
+            except ImportError:
+                return None
+            try:
+                index = _TrigramIndex(os.path.join(dirname, name))
+            except sqlite3.Error:
+                return None
+            grep._indexes[path] = index
+        return index
+
+
+class grep_open(Command):
+    """:grep_open [<n>]
+
+    Opens the current file in $EDITOR at a match found by :grep -l
+
+    Without an argument, every call jumps to the next match of the file.
+    """
+
+    def execute(self):
+        import shlex
+
+        fobj = self.fm.thisfile
+        hits = getattr(fobj, 'grep_hits', None)
+        if not hits:
+            self.fm.notify("grep_open: no matches for this file", bad=True)
+            return
+        if self.arg(1):
+            try:
+                index = int(self.arg(1)) - 1
+            except ValueError:
+                self.fm.notify("Syntax: grep_open [<n>]", bad=True)
+                return
+        else:
+            index = getattr(fobj, 'grep_hit_index', -1) + 1
+        fobj.grep_hit_index = index = index % len(hits)
+        line, column, _ = hits[index]
+        editor = os.environ.get('VISUAL') or os.environ.get('EDITOR') or 'vim'
+        self.fm.notify("grep_open: match %d of %d, column %d" % (index + 1, len(hits), column))
+        self.fm.execute_command(shlex.split(editor) + ['+%d' % line, fobj.path])
+
+
+class _FlatStream(object):
+    """Loads a flattened view of a directory incrementally
+
+    Directory.load_bit_by_bit walks the whole subtree in a single loader
+    step before the first entry is shown.  This walks one directory per
+    step instead and publishes the entries found so far in chunks, so the
+    view fills in while the loader is still working.  Removing the task
+    from the taskview or running :flat again cancels it and keeps what
+    has been listed so far.
+
+    The entries of every walked directory are kept per (root, level)
+    together with the directory's mtime, so loading the same view again
+    only rescans the directories that changed in the meantime.
+    """
+
+    # (root, level) -> {dirpath: (mtime, items)}, least recently used first
+    _views = None
+
+    def __init__(self, fm, directory, level, max_entries=None, chunk_size=500,
+                 cached_views=4, recheck_interval=2):
+        self.fm = fm
+        self.directory = directory
+        self.level = level
+        self.max_entries = max_entries
+        self.chunk_size = chunk_size
+        self.cached_views = cached_views
+        self.recheck_interval = recheck_interval
+        self.generator = None
+        self.finished = False
+        self.truncated = False
+        self.load_content_mtime = 0
+        self.marked_paths = set()
+        self.scanned = {}
+        self._next_sort = 0
+        self._next_check = 0
+
+    def start(self):
+        directory = self.directory
+        self.stop(directory)
+        directory.unload()
+        directory.flat = self.level
+        # Ranger re-checks the mtime of every directory in a flattened
+        # view on each redraw by walking the tree again.  Check the
+        # directories we already know about instead.
+        directory.load_content_if_outdated = self._load_content_if_outdated
+        directory.unload = self._unload
+        self.generator = self._load()
+        directory.load_generator = self.generator
+        self.fm.loader.add(directory)
+
+    @staticmethod
+    def stop(directory):
+        """Detach a stream from the directory, cancelling it if it's running"""
+        directory.__dict__.pop('load_content_if_outdated', None)
+        unload = directory.__dict__.pop('unload', None)
+        if unload is not None:
+            unload.__self__.cancel()
+
+    def cancel(self):
+        """Stop the walk, caching the directories scanned so far"""
+        if self.is_current():
+            self.directory.load_generator = None
+        if self.generator is not None:
+            self.generator.close()
+
+    def _unload(self):
+        directory = self.directory
+        self.stop(directory)
+        directory.unload()
+        if directory.files_all is not None:
+            # Keep the partial listing instead of loading it all over again
+            directory.content_loaded = True
+
+    def is_current(self):
+        return self.directory.load_generator is self.generator
+
+    def _load_content_if_outdated(self, *_args, **_kwargs):
+        from time import time
+
+        if not self.finished or time() < self._next_check:
+            return False
+        self._next_check = time() + self.recheck_interval
+        for dirpath, (mtime, _) in self.scanned.items():
+            try:
+                if os.stat(dirpath).st_mtime == mtime:
+                    continue
+            except OSError:
+                pass
+            _FlatStream(self.fm, self.directory, self.level, self.max_entries,
+                        self.chunk_size, self.cached_views, self.recheck_interval).start()
+            return True
+        return False
+
+    def _get_cached(self):
+        from collections import OrderedDict
+
+        if _FlatStream._views is None:
+            _FlatStream._views = OrderedDict()
+        return _FlatStream._views.pop((self.directory.path, self.level), {})
+
+    def _put_cached(self, view):
+        views = _FlatStream._views
+        views[(self.directory.path, self.level)] = view
+        while len(views) > self.cached_views:
+            views.popitem(last=False)
+
+    def _load(self):
+        from collections import deque
+        from time import time
+        from ranger.ext.mount_path import mount_path
+
+        directory = self.directory
+        directory.loading = True
+        directory.percent = 0
+        directory.load_if_outdated()
+        cached = self._get_cached()
+        try:
+            if directory.runnable:
+                yield
+                directory.mount_path = mount_path(directory.path)
+                self.marked_paths = set(obj.path for obj in directory.marked_items)
+                directory._clear_marked_items()  # pylint: disable=protected-access
+                directory.filenames = []
+                directory.files_all = []
+                directory.disk_usage = 0
+
+                pending = deque([(directory.path, 0)])
+                batch = []
+                while pending:
+                    dirpath, depth = pending.popleft()
+                    for item in self._list(dirpath, cached):
+                        batch.append(item)
+                        if item.is_directory and (self.level == -1 or depth < self.level) \
+                                and (self.level > 0 or not item.is_link):
+                            pending.append((item.path, depth + 1))
+                        if len(batch) >= self.chunk_size:
+                            self._publish(batch)
+                            batch = []
+                            yield
+                        if self.max_entries is not None and \
+                                len(directory.files_all) + len(batch) >= self.max_entries:
+                            self.truncated = True
+                            break
+                    if self.truncated:
+                        break
+                    scanned = len(self.scanned)
+                    directory.percent = 100 * scanned // (scanned + len(pending))
+                    yield
+                self._publish(batch, final=True)
+                directory.load_content_mtime = self.load_content_mtime
+            else:
+                directory.filenames = None
+                directory.files_all = None
+                directory.files = None
+
+            directory.cycle_list = None
+            directory.content_loaded = True
+            directory.last_update_time = time()
+            directory.correct_pointer()
+            self.finished = True
+            self._next_check = time() + self.recheck_interval
+            if self.truncated:
+                self.fm.notify("flat: stopped after %d entries" % len(directory.files_all),
+                               bad=True)
+        finally:
+            if self.finished:
+                self._put_cached(self.scanned)
+            else:
+                cached.update(self.scanned)
+                self._put_cached(cached)
+            if self.is_current():
+                directory.loading = False
+                self.fm.signal_emit("finished_loading_dir", directory=directory)
+                if directory.vcs:
+                    self.fm.ui.vcsthread.process(directory)
+
+    def _list(self, dirpath, cached):
+        """Return the entries of one directory, rescanning it if it changed"""
+        try:
+            mtime = os.stat(dirpath).st_mtime
+        except OSError:
+            return []
+        entry = cached.get(dirpath)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, self._scan(dirpath))
+        self.scanned[dirpath] = entry
+        self.load_content_mtime = max(self.load_content_mtime, mtime)
+        return entry[1]
+
+    def _scan(self, dirpath):
+        """Create the File objects for one directory of the tree"""
+        from ranger.container.file import File
+
+        try:
+            names = os.listdir(dirpath)
+        except OSError:
+            return []
+        root = self.directory.path
+        items = []
+        for name in names:
+            path = os.path.join(dirpath, name)
+            try:
+                file_lstat = os.lstat(path)
+                if file_lstat.st_mode & 0o170000 == 0o120000:
+                    file_stat = os.stat(path)
+                else:
+                    file_stat = file_lstat
+                stats = (file_stat, file_lstat)
+            except OSError:
+                stats = None
+            if stats and file_stat.st_mode & 0o170000 == 0o040000:
+                item = self.fm.get_directory(path, preload=stats, path_is_abs=True,
+                                             basename_is_rel_to=root)
+                item.load_if_outdated()
+                item.relative_path = os.path.relpath(item.path, root)
+                item.relative_path_lower = item.relative_path.lower()
+            else:
+                item = File(path, preload=stats, path_is_abs=True, basename_is_rel_to=root)
+                item.load()
+            items.append(item)
+        return items
+
+    def _publish(self, batch, final=False):
+        """Append a batch of entries and refresh the view now and then
+
+        Re-sorting is the expensive part, so it only happens once the
+        listing has grown by half since the last time.
+        """
+        from time import time
+
+        directory = self.directory
+        for item in batch:
+            if item.path in self.marked_paths:
+                item.mark_set(True)
+                directory.marked_items.append(item)
+            else:
+                item.mark_set(False)
+            if item.is_directory:
+                if item.stat:
+                    self.load_content_mtime = max(self.load_content_mtime,
+                                                  item.stat.st_mtime)
+            else:
+                directory.disk_usage += item.size
+        directory.files_all.extend(batch)
+        directory.filenames.extend(item.path for item in batch)
+        directory.size = len(directory.files_all)
+        directory.infostring = ' %d' % directory.size
+        if directory.is_link:
+            directory.infostring = '->' + directory.infostring
+
+        if final or directory.size >= self._next_sort:
+            self._next_sort = max(self.chunk_size, directory.size * 3 // 2)
+            directory.sort()
+            if directory.files:
+                directory.content_loaded = True
+                if directory.pointed_obj is not None:
+                    directory.sync_index()
+                else:
+                    directory.move(to=0)
+            directory.last_update_time = time()
 
 
 class flat(Command):
@@ -1734,8 +3990,16 @@ class flat(Command):
 
         -1 fully flattened
          0 remove flattened view
+
+    The flattened view is loaded in the background and filled in while
+    the subtree is walked.  At most `max_entries' entries are listed.  The
+    last `cached_views' flattened views are remembered, so switching back
+    to one only rescans the directories whose mtime changed.
     """
 
+    max_entries = 250000
+    cached_views = 4
+
     def execute(self):
         try:
             level_str = self.rest(1)
@@ -1747,21 +4011,976 @@ class flat(Command):
             return
         if level < -1:
             self.fm.notify("Need an integer number (-1, 0, 1, ...)", bad=True)
-        self.fm.thisdir.unload()
-        self.fm.thisdir.flat = level
-        self.fm.thisdir.load_content()
+            return
+        thisdir = self.fm.thisdir
+        if level == 0:
+            _FlatStream.stop(thisdir)
+            thisdir.unload()
+            thisdir.flat = level
+            thisdir.load_content()
+            return
+        _FlatStream(self.fm, thisdir, level, max_entries=self.max_entries,
+                    cached_views=self.cached_views).start()
+
+
+class _PreviewCache(_JsonStore):
+    """A persistent cache of the output of the preview script
+
+    Every preview is stored in a file named after the SHA-1 of the path,
+    size and mtime of the previewed file and the pane size it was made
+    for, where -1 stands for any width or height as in fm.previews.  So
+    a preview that the script marked as independent of the width (exit
+    code 3), height (4) or both (5) is found for any pane size.  The index
+    maps these names to [bytes, last use, path].  The least recently used
+    previews are dropped once they take more than `max_bytes', and all of
+    them when the preview script changes.  The index is written at most
+    every `save_interval' seconds and when ranger exits.
+    """
+
+    max_bytes = 64 << 20
+    save_interval = 30
+    _instance = None
+
+    def __init__(self, directory, script):
+        self.directory = directory
+        self.next_save = 0
+        _JsonStore.__init__(self, os.path.join(directory, 'index.json'))
+        try:
+            script_mtime = os.stat(script).st_mtime if script else None
+        except OSError:
+            script_mtime = None
+        if self.entries.get('script') != script_mtime or 'previews' not in self.entries:
+            self.clear()
+            self.entries = {'script': script_mtime, 'previews': {}}
+            self.dirty = True
+        self.previews = self.entries['previews']
+        self.total = sum(entry[0] for entry in self.previews.values())
+
+    @classmethod
+    def get(cls, fm):
+        import atexit
+        import ranger
+
+        if cls._instance is None:
+            directory = os.path.join(ranger.args.cachedir, 'previews')
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            cls._instance = cls(directory, fm.settings.preview_script)
+            atexit.register(cls._instance.save)
+        return cls._instance
+
+    def save_later(self):
+        """Saves the index if it hasn't been saved for `save_interval' seconds"""
+        from time import time
+
+        if time() >= self.next_save:
+            self.save()
+            self.next_save = time() + self.save_interval
+
+    @staticmethod
+    def _name(path, stat, key):
+        from hashlib import sha1
+
+        ident = '%s\0%d\0%r\0%d\0%d' % ((path, stat.st_size, stat.st_mtime) + key)
+        return sha1(ident.encode('utf-8', 'backslashreplace')).hexdigest()
+
+    def lookup(self, path, width, height):
+        """Returns (key, content) of a cached preview or None"""
+        from time import time
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        for key in ((-1, -1), (width, -1), (-1, height), (width, height)):
+            name = self._name(path, stat, key)
+            entry = self.previews.get(name)
+            if entry is None:
+                continue
+            try:
+                with open(os.path.join(self.directory, name), 'rb') as fobj:
+                    content = fobj.read()
+            except (IOError, OSError):
+                self._drop(name)
+                continue
+            entry[1] = time()
+            self.dirty = True
+            if not isinstance(content, str):
+                content = content.decode('utf-8', 'surrogateescape')
+            return key, content
+        return None
+
+    def store(self, path, key, content):
+        from time import time
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8', 'surrogateescape')
+        name = self._name(path, stat, key)
+        try:
+            with open(os.path.join(self.directory, name), 'wb') as fobj:
+                fobj.write(content)
+        except (IOError, OSError):
+            return
+        if name in self.previews:
+            self.total -= self.previews[name][0]
+        self.previews[name] = [len(content), time(), path]
+        self.total += len(content)
+        self.dirty = True
+        if self.total > self.max_bytes:
+            # Make some room at once rather than on every store
+            for name in sorted(self.previews, key=lambda name: self.previews[name][1]):
+                if self.total <= self.max_bytes * 9 // 10:
+                    break
+                self._drop(name)
+        self.save_later()
+
+    def _drop(self, name):
+        entry = self.previews.pop(name, None)
+        if entry is not None:
+            self.total -= entry[0]
+            self.dirty = True
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def invalidate(self, prefix):
+        """Drops the previews of `prefix' and everything below it"""
+        for name, entry in list(self.previews.items()):
+            if entry[2] == prefix or entry[2].startswith(prefix.rstrip('/') + '/'):
+                self._drop(name)
+        self.save()
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name != os.path.basename(self.path):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+        if 'previews' in self.entries:
+            self.entries['previews'].clear()
+            self.total = 0
+            self.dirty = True
+            self.save()
+
+
+class _PreviewData(dict):
+    """The entry of one file in fm.previews that saves new previews to disk"""
+
+    def __init__(self, cache, path):
+        dict.__init__(self, loading=False)
+        self.cache = cache
+        self.path = path
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        if isinstance(key, tuple) and value is not None and self.cache is not None:
+            self.cache.store(self.path, key, value)
+
+
+def _restore_preview(fm, path, width, height):
+    """Adds the entry of `path' to fm.previews, with its cached preview
+
+    Returns True if a preview was found on disk.
+    """
+    cache = _PreviewCache.get(fm)
+    data = fm.previews[path] = _PreviewData(cache, path)
+    found = cache.lookup(path, width, height)
+    if found is None:
+        return False
+    dict.__setitem__(data, found[0], found[1])
+    data['foundpreview'] = True
+    return True
+
+
+def _set_preview(fm, data, width, height, rcode, content):  # pylint: disable=too-many-arguments
+    """Stores a preview in `data' the way ranger reads the preview script's exit code"""
+    data['foundpreview'] = True
+    if rcode == 0:
+        data[(width, height)] = content
+    elif rcode == 3:
+        data[(-1, height)] = content
+    elif rcode == 4:
+        data[(width, -1)] = content
+    elif rcode == 5:
+        data[(-1, -1)] = content
+    elif rcode == 7:
+        data['directimagepreview'] = True
+    elif rcode == 1:
+        data[(-1, -1)] = None
+        data['foundpreview'] = False
+    elif rcode == 2:
+        text = fm.read_text_file(data.path, 1024 * 32)
+        if not isinstance(text, str):
+            text = text.encode('utf-8')
+        data[(-1, -1)] = text
+    elif rcode != 6:
+        # 6 leaves an image behind, which get_preview finds by itself
+        data[(-1, -1)] = None
+    data['loading'] = False
+
+
+_PREVIEW_HANDLERS = {}
+_PREVIEW_JSON_MAX = 1 << 20
+
+
+def _preview_handler(*extensions):
+    """Registers a function as the in-process previewer of `extensions'
+
+    The function is called with the path and the size of the preview pane
+    before the preview script is run.  It returns a pair (exit code, text),
+    where the exit code means the same as for the preview script, or None
+    to leave the file to the preview script after all.
+    """
+    def register(handler):
+        for extension in extensions:
+            _PREVIEW_HANDLERS[extension] = handler
+        return handler
+    return register
+
+
+def _preview_handler_for(path):
+    """Returns the in-process previewer of `path' or None
+
+    Compound extensions like tar.gz take precedence over their last part.
+    """
+    extensions = os.path.basename(path).lower().split('.')[1:]
+    for i in range(len(extensions)):
+        handler = _PREVIEW_HANDLERS.get('.'.join(extensions[i:]))
+        if handler is not None:
+            return handler
+    return None
+
+
+def _preview_in_process(fm, path, width, height):
+    """Adds the preview of `path' to fm.previews if an in-process previewer has one
+
+    These previews are cheap to make again, so they are not cached on disk.
+    """
+    handler = _preview_handler_for(path)
+    if handler is None:
+        return False
+    result = handler(path, width, height)
+    if result is None:
+        return False
+    data = fm.previews[path] = _PreviewData(None, path)
+    _set_preview(fm, data, width, height, *result)
+    return True
+
+
+def _listing(lines, height, more):
+    """Joins the lines of an archive listing, ending it with a note if it's cut"""
+    if more:
+        lines[height - 1:] = ['... (%s more)' % more if more is not True else '...']
+    return '\n'.join(lines)
+
+
+@_preview_handler('zip', 'jar', 'war', 'xpi')
+def _preview_zip(path, width, height):  # pylint: disable=unused-argument
+    import zipfile
+
+    try:
+        archive = zipfile.ZipFile(path)
+    except (IOError, OSError, zipfile.BadZipfile):
+        return None
+    with archive:
+        infos = archive.infolist()
+    lines = ['%10d  %04d-%02d-%02d %02d:%02d  %s' % ((info.file_size,) + info.date_time[:5]
+                                                     + (info.filename,))
+             for info in infos[:height]]
+    return 3, _listing(lines, height, len(infos) - height + 1 if len(infos) > height else 0)
+
+
+@_preview_handler('tar', 'tgz', 'tar.gz', 'tbz', 'tbz2', 'tar.bz2', 'txz', 'tar.xz')
+def _preview_tar(path, width, height):  # pylint: disable=unused-argument
+    import tarfile
+    from time import localtime, strftime
+
+    lines = []
+    more = False
+    try:
+        with tarfile.open(path) as archive:
+            # Only read as far into the (compressed) archive as can be shown
+            for info in archive:
+                if len(lines) == height:
+                    more = True
+                    break
+                lines.append('%10d  %s  %s' % (
+                    info.size, strftime('%Y-%m-%d %H:%M', localtime(info.mtime)),
+                    info.name + '/' if info.isdir() else info.name))
+    except (IOError, OSError, EOFError, tarfile.TarError):
+        return None
+    return 3, _listing(lines, height, more)
+
+
+@_preview_handler('json')
+def _preview_json(path, width, height):  # pylint: disable=unused-argument
+    import json
+    from collections import OrderedDict
+
+    try:
+        if os.path.getsize(path) > _PREVIEW_JSON_MAX:
+            return None
+        with open(path) as fobj:
+            data = json.load(fobj, object_pairs_hook=OrderedDict)
+    except (IOError, OSError, ValueError):
+        return None
+    return 5, json.dumps(data, indent=2, ensure_ascii=False)
+
+
+def _head(path, lines, budget):
+    """Returns the first `lines' lines of a text file, or None if it looks binary
+
+    At most `budget' bytes are read, so a huge file without line breaks
+    costs no more than a short one.
+    """
+    with open(path, 'rb') as fobj:
+        head = fobj.read(budget)
+    if b'\0' in head:
+        return None
+    return b'\n'.join(head.split(b'\n')[:lines]).decode('utf-8', 'replace')
+
+
+def _tail(path, lines, budget, block_size=8192):
+    """Returns the last `lines' lines of a text file, or None if it looks binary
+
+    The file is read backwards a block at a time until it has enough line
+    breaks or `budget' bytes have been read.
+    """
+    with open(path, 'rb') as fobj:
+        fobj.seek(0, 2)
+        position = fobj.tell()
+        blocks = []
+        newlines = size = 0
+        while position > 0 and newlines <= lines and size < budget:
+            step = min(block_size, position, budget - size)
+            position -= step
+            fobj.seek(position)
+            block = fobj.read(step)
+            blocks.append(block)
+            newlines += block.count(b'\n')
+            size += len(block)
+    tail = b''.join(reversed(blocks))
+    if b'\0' in tail:
+        return None
+    return b'\n'.join(tail.rstrip(b'\n').split(b'\n')[-lines:]).decode('utf-8', 'replace')
+
+
+@_preview_handler('txt', 'text', 'csv', 'tsv')
+def _preview_text(path, width, height):
+    try:
+        text = _head(path, height, width * height * 4)
+    except (IOError, OSError):
+        return None
+    return None if text is None else (3, text)
+
+
+@_preview_handler('log')
+def _preview_log(path, width, height):
+    try:
+        text = _tail(path, height, width * height * 4)
+    except (IOError, OSError):
+        return None
+    return None if text is None else (3, text)
+
+
+class _PreviewPrefetch(Loadable):
+    """Runs the preview script for the file under the cursor and its neighbours
+
+    The current file and the next and previous `neighbours' files of the
+    current directory are previewed by `workers' threads, nearest first,
+    so that the preview is usually ready by the time the cursor gets
+    there.  The results follow the exit codes of the preview script and
+    are stored in fm.previews from the main thread.  When the cursor
+    moves, files that are no longer near it are dropped from the queue
+    and their previews are aborted.
+
+    Only `pages' screens of output are read, and at most `bytes_per_cell'
+    bytes per character cell of the pane to allow for color codes.  Then
+    the preview script is killed and the preview is kept for the current
+    pane size only, as if the script had exited with 0.
+    """
+
+    neighbours = 3
+    workers = 2
+    pages = 1
+    bytes_per_cell = 16
+    _instance = None
+
+    def __init__(self, fm):
+        import threading
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue  # pylint: disable=import-error
+
+        Loadable.__init__(self, None, 'Prefetching previews')
+        self.fm = fm
+        self.lock = threading.Lock()
+        self.todo = queue.PriorityQueue()
+        self.done = queue.Queue()
+        self.wanted = {}
+        self.pending = set()
+        self.running = {}
+        self.generation = 0
+        self.position = None
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    @classmethod
+    def get(cls, fm):
+        if cls._instance is None:
+            cls._instance = cls(fm)
+        return cls._instance
+
+    def schedule(self, directory, width, height):
+        """Queues the previews of the files around the cursor in `directory'"""
+        files = directory.files or []
+        current = directory.pointer
+        position = (directory, id(files), current, width, height)
+        if position == self.position:
+            return
+        self.position = position
+
+        wanted = {}
+        queued = []
+        first = None
+        order = [current]
+        for distance in range(1, self.neighbours + 1):
+            order.extend((current + distance, current - distance))
+        for priority, i in enumerate(order):
+            if not 0 <= i < len(files):
+                continue
+            fobj = files[i]
+            path = fobj.realpath
+            if not fobj.is_file or not path or _preview_handler_for(path) is not None:
+                continue
+            if i == current and self.fm.settings.preview_images:
+                # Leave it to get_preview, which knows about cached images
+                continue
+            if priority == 0:
+                first = path
+            data = self.fm.previews.get(path)
+            if data is not None:
+                if getattr(data, 'prefetched', False):
+                    # The cursor has been on it while its preview was on its way
+                    wanted[path] = (width, height)
+                continue
+            if path in self.pending and self.wanted.get(path) == (width, height):
+                wanted[path] = (width, height)
+                continue
+            if _restore_preview(self.fm, path, width, height):
+                continue
+            del self.fm.previews[path]
+            wanted[path] = (width, height)
+            queued.append((priority, path))
+
+        with self.lock:
+            for path, process in self.running.items():
+                if wanted.get(path) != self.wanted.get(path):
+                    try:
+                        process.kill()
+                    except OSError:
+                        pass
+            self.wanted = wanted
+            for priority, path in queued:
+                self.pending.add(path)
+                self.todo.put((priority, path))
+            pending = bool(self.pending)
+            # The preview under the cursor is waited for, so it must not
+            # wait behind other tasks
+            urgent = first in wanted and first in self.pending
+        if pending and self.load_generator is None:
+            self.load_generator = self.generate()
+            self.fm.loader.add(self, append=not urgent)
+        elif urgent and self.load_generator is not None:
+            self.fm.loader.add(self)
+
+    def adopt(self, path, width, height):
+        """Lets the preview of `path' be made by the prefetcher if it is on its way"""
+        with self.lock:
+            if path not in self.pending or self.wanted.get(path) != (width, height):
+                return False
+        data = self.fm.previews[path] = _PreviewData(_PreviewCache.get(self.fm), path)
+        data['loading'] = True
+        data.prefetched = True
+        return True
+
+    def _work(self):
+        import ranger
+        from subprocess import Popen, PIPE
+
+        devnull = open(os.devnull, 'r+')
+        while True:
+            path = self.todo.get()[1]
+            with self.lock:
+                if path not in self.wanted:
+                    self.pending.discard(path)
+                    continue
+                if path not in self.pending:
+                    # Queued more than once and done already
+                    continue
+                width, height = self.wanted[path]
+                generation = self.generation
+                try:
+                    process = Popen(
+                        [self.fm.settings.preview_script, path, str(width), str(height),
+                         os.path.join(ranger.args.cachedir, self.fm.sha1_encode(path)),
+                         str(self.fm.settings.preview_images)],
+                        stdin=devnull, stdout=PIPE, stderr=devnull, close_fds=True)
+                except OSError:
+                    self.pending.discard(path)
+                    continue
+                self.running[path] = process
+            content, truncated = self._read(process, width, height)
+            with self.lock:
+                if self.running.get(path) is process:
+                    del self.running[path]
+                if generation != self.generation:
+                    # Killed by destroy()
+                    continue
+                self.pending.discard(path)
+            self.done.put((path, width, height, 0 if truncated else process.returncode, content))
+
+    def _read(self, process, width, height):
+        """Reads the output of the preview script up to what fits in the pane
+
+        Returns the output and whether the script had to be cut short.
+        """
+        lines = []
+        budget = height * width * self.pages * self.bytes_per_cell
+        truncated = False
+        for line in iter(lambda: process.stdout.readline(budget), b''):
+            lines.append(line)
+            budget -= len(line)
+            if len(lines) >= height * self.pages or budget <= 0:
+                truncated = True
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+                break
+        process.stdout.close()
+        process.wait()
+        return b''.join(lines), truncated
+
+    def generate(self):
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue  # pylint: disable=import-error
+
+        try:
+            while True:
+                try:
+                    result = self.done.get(timeout=0.02)
+                except queue.Empty:
+                    with self.lock:
+                        if not self.pending:
+                            break
+                else:
+                    self._store(*result)
+                yield
+        finally:
+            self.load_generator = None
+
+    def _store(self, path, width, height, rcode, content):  # pylint: disable=too-many-arguments
+        from ranger.core.loader import safe_decode
+
+        data = self.fm.previews.get(path)
+        if data is not None and not getattr(data, 'prefetched', False):
+            return
+        if rcode is None or rcode < 0:
+            if data is not None:
+                del self.fm.previews[path]
+            return
+        if data is None:
+            data = self.fm.previews[path] = _PreviewData(_PreviewCache.get(self.fm), path)
+        data.prefetched = False
+        _set_preview(self.fm, data, width, height, rcode, safe_decode(content))
+
+        thisfile = self.fm.thisfile
+        if thisfile and thisfile.realpath == path:
+            self.fm.ui.browser.need_redraw = True
+            if thisfile.is_file and rcode not in (6, 7):
+                pager = self.fm.ui.get_pager()
+                pager.set_source(thisfile.get_preview_source(pager.wid, pager.hei))
+
+    def destroy(self):
+        # Removed from the taskview: forget everything, so that the next
+        # schedule() starts over and adds the prefetcher to the loader again
+        with self.lock:
+            self.wanted = {}
+            self.pending.clear()
+            self.generation += 1
+            for process in self.running.values():
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+        generator, self.load_generator = self.load_generator, None
+        if generator is not None:
+            generator.close()
+        self.position = None
+        for path, data in list(self.fm.previews.items()):
+            if getattr(data, 'prefetched', False):
+                del self.fm.previews[path]
+
+
+_THUMBNAIL_FLAVOR = ('x-large', 512)
+_THUMBNAIL_FONT_TEXT = ('  ABCDEFGHIJKLMNOPQRSTUVWXYZ  ', '  abcdefghijklmnopqrstuvwxyz  ',
+                        "  0123456789.:,;(*!?') ff fl fi ffi ffl  ",
+                        '  The quick brown fox jumps over the lazy dog.  ')
+_THUMBNAILERS = (
+    (re.compile(r'^image/'), (
+        ('convert', '--', '{path}[0]', '-auto-orient', '-thumbnail', '{size}x{size}>',
+         'png:{output}'),
+    )),
+    (re.compile(r'^video/'), (
+        ('ffmpegthumbnailer', '-i', '{path}', '-o', '{output}', '-s', '{size}', '-c', 'png'),
+    )),
+    (re.compile(r'^application/pdf$'), (
+        ('pdftoppm', '-f', '1', '-l', '1', '-scale-to', '{size}', '-singlefile', '-png',
+         '{path}', '{output_base}'),
+    )),
+    (re.compile(r'^font/|^application/(x-)?font|opentype'), (
+        ('fontimage', '-o', '{output}', '--pixelsize', '120', '--fontname', '--pixelsize', '80')
+        + sum((('--text', text) for text in _THUMBNAIL_FONT_TEXT), ()) + ('{path}',),
+        ('convert', '--', '{output}', '-thumbnail', '{size}x{size}>', 'png:{output}'),
+    )),
+)
+
+
+def _thumbnail_paths(path):
+    """Returns the file URI of `path' and where its thumbnail belongs
+
+    This is the freedesktop.org thumbnail layout: the thumbnail is called
+    after the MD5 of the URI and shared with other programs that use it.
+    """
+    from hashlib import md5
+    try:
+        from urllib.parse import quote
+    except ImportError:
+        from urllib import quote  # pylint: disable=no-name-in-module
+
+    path = os.path.abspath(path)
+    if not isinstance(path, bytes):
+        path = path.encode('utf-8', 'surrogateescape')
+    # Escape like GLib's g_filename_to_uri(), whose URIs the other programs
+    # hash: "/tmp/Photo (1).jpg" is "file:///tmp/Photo%20(1).jpg"
+    uri = 'file://' + quote(path, safe="/!$&'()*+,=:@~")
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return uri, os.path.join(cache, 'thumbnails', _THUMBNAIL_FLAVOR[0],
+                             md5(uri.encode('ascii')).hexdigest() + '.png')
+
+
+def _png_text(filename):
+    """Returns the tEXt chunks in the header of a PNG file as a dict"""
+    import struct
+
+    text = {}
+    with open(filename, 'rb') as fobj:
+        if fobj.read(8) != b'\x89PNG\r\n\x1a\n':
+            return text
+        while True:
+            header = fobj.read(8)
+            if len(header) < 8:
+                break
+            length, kind = struct.unpack('>I4s', header)
+            if kind in (b'IDAT', b'IEND'):
+                break
+            if kind == b'tEXt':
+                key, _, value = fobj.read(length).partition(b'\0')
+                text[key.decode('latin-1')] = value.decode('latin-1')
+                fobj.seek(4, 1)
+            else:
+                fobj.seek(length + 4, 1)
+    return text
+
+
+def _png_add_text(filename, items):
+    """Adds tEXt chunks right after the IHDR chunk of a PNG file"""
+    import struct
+    import zlib
+
+    with open(filename, 'rb') as fobj:
+        data = fobj.read()
+    if data[:8] != b'\x89PNG\r\n\x1a\n' or data[12:16] != b'IHDR':
+        raise ValueError('not a PNG file: %s' % filename)
+    end = 8 + 12 + struct.unpack('>I', data[8:12])[0]
+    chunks = []
+    for key, value in items:
+        chunk = b'tEXt' + key.encode('latin-1') + b'\0' + value.encode('latin-1')
+        chunks.append(struct.pack('>I', len(chunk) - 4) + chunk
+                      + struct.pack('>I', zlib.crc32(chunk) & 0xffffffff))
+    with open(filename, 'wb') as fobj:
+        fobj.write(data[:end] + b''.join(chunks) + data[end:])
+
+
+def _valid_thumbnail(path):
+    """Returns the path of an up to date thumbnail of `path' or None"""
+    uri, thumbnail = _thumbnail_paths(path)
+    try:
+        text = _png_text(thumbnail)
+        mtime = int(os.stat(path).st_mtime)
+    except (IOError, OSError):
+        return None
+    if text.get('Thumb::URI') != uri or text.get('Thumb::MTime') != str(mtime):
+        return None
+    return thumbnail
+
+
+def _thumbnailer_for(path):
+    """Returns the commands that make a thumbnail of `path' or None"""
+    import mimetypes
+
+    mimetype = mimetypes.guess_type(path, strict=False)[0]
+    if mimetype is None:
+        return None
+    for pattern, commands in _THUMBNAILERS:
+        if pattern.search(mimetype):
+            return commands
+    return None
+
+
+class _ThumbnailLoader(Loadable):
+    """Makes the freedesktop.org thumbnails of some files in parallel
+
+    Every one of `workers' threads runs the thumbnailer commands of one
+    file at a time, into a temporary file next to the thumbnails.  It then
+    adds the Thumb::URI and Thumb::MTime chunks and moves the thumbnail
+    into place, as the specification asks for.
+    """
+
+    progressbar_supported = True
+
+    def __init__(self, fm, paths, workers=4):
+        Loadable.__init__(self, self.generate(), 'Creating thumbnails')
+        self.fm = fm
+        self.paths = paths
+        self.workers = workers
+        self.created = []
+        self.failed = 0
+        self._stop = None
+        self._running = set()
+
+    def cancel(self):
+        if self._stop is not None:
+            self._stop.set()
+        for process in list(self._running):
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+    def destroy(self):
+        self.cancel()
+
+    def generate(self):
+        import threading
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue  # pylint: disable=import-error
+
+        todo = queue.Queue()
+        done = queue.Queue()
+        self._stop = stop = threading.Event()
+        for path in self.paths:
+            todo.put(path)
+
+        def work():
+            while not stop.is_set():
+                try:
+                    path = todo.get_nowait()
+                except queue.Empty:
+                    return
+                done.put((path, self._make(path)))
+
+        for _ in range(min(self.workers, len(self.paths))):
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+
+        finished = 0
+        while finished < len(self.paths) and not stop.is_set():
+            try:
+                path, created = done.get(timeout=0.02)
+            except queue.Empty:
+                yield
+                continue
+            finished += 1
+            if created:
+                self.created.append(path)
+            else:
+                self.failed += 1
+            self.percent = 100 * finished // len(self.paths)
+            yield
+        self._finish()
+
+    def _make(self, path):
+        from tempfile import mkstemp
+
+        uri, thumbnail = _thumbnail_paths(path)
+        directory = os.path.dirname(thumbnail)
+        try:
+            mtime = int(os.stat(path).st_mtime)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            fd, output = mkstemp(suffix='.png', prefix='ranger-', dir=directory)
+            os.close(fd)
+        except OSError:
+            return False
+        fields = {'path': path, 'output': output, 'output_base': output[:-4],
+                  'size': str(_THUMBNAIL_FLAVOR[1])}
+        try:
+            for command in _thumbnailer_for(path):
+                if self._stop.is_set() or \
+                        self._run([arg.format(**fields) for arg in command]) != 0:
+                    return False
+            _png_add_text(output, (('Thumb::URI', uri), ('Thumb::MTime', str(mtime))))
+            os.rename(output, thumbnail)
+            return True
+        except (IOError, OSError, ValueError):
+            return False
+        finally:
+            if os.path.exists(output):
+                os.remove(output)
+
+    def _run(self, args):
+        from subprocess import Popen
+
+        with open(os.devnull, 'r+') as devnull:
+            try:
+                process = Popen(args, stdin=devnull, stdout=devnull, stderr=devnull,
+                                close_fds=True)
+            except OSError:
+                return None
+            self._running.add(process)
+            try:
+                return process.wait()
+            finally:
+                self._running.discard(process)
+
+    def _finish(self):
+        for path in self.created:
+            self.fm.previews.pop(path, None)
+        self.fm.ui.need_redraw = True
+        if self.failed:
+            self.fm.notify('Created %d thumbnails, %d failed'
+                           % (len(self.created), self.failed), bad=True)
+        else:
+            self.fm.notify('Created %d thumbnails' % len(self.created))
+
+
+def _install_preview_hooks():
+    """Makes fm.get_preview use freedesktop.org thumbnails as image previews
+    and the in-process previewers, the persistent preview cache and the
+    prefetcher for the others, in this order
+
+    Wraps ranger.core.actions.Actions.get_preview, the way ranger's
+    plugins wrap its hooks.
+    """
+    from ranger.core.actions import Actions
+
+    if hasattr(Actions.get_preview, 'old_get_preview'):
+        return
+    old_get_preview = Actions.get_preview
+
+    def get_preview(self, fobj, width, height):
+        path = fobj.realpath
+        if not path or not self.settings.preview_script \
+                or not self.settings.use_preview_script:
+            return old_get_preview(self, fobj, width, height)
+        data = self.previews.get(path)
+        if data is not None and 'thumbnail' in data:
+            return data['thumbnail']
+        if data is None and self.settings.preview_images and _thumbnailer_for(path):
+            thumbnail = _valid_thumbnail(path)
+            if thumbnail is not None:
+                self.previews[path] = {'loading': False, 'foundpreview': True,
+                                       'imagepreview': True, 'thumbnail': thumbnail}
+                self.ui.get_pager().set_image(thumbnail)
+                return thumbnail
+        prefetch = _PreviewPrefetch.get(self)
+        if self.thisdir is not None and fobj is self.thisfile:
+            prefetch.schedule(self.thisdir, width, height)
+        if path not in self.previews and not _preview_in_process(self, path, width, height) \
+                and not _restore_preview(self, path, width, height) \
+                and prefetch.adopt(path, width, height):
+            return None
+        return old_get_preview(self, fobj, width, height)
+
+    get_preview.old_get_preview = old_get_preview
+    Actions.get_preview = get_preview
+
+
+_install_preview_hooks()
 
 
 class reset_previews(Command):
-    """:reset_previews
+    """:reset_previews [-a]
 
-    Reset the file previews.
+    Reset the file previews of the current directory, including the ones
+    cached on disk.  With -a, reset all file previews.
     """
     def execute(self):
-        self.fm.previews = {}
+        if self.arg(1) == '-a':
+            self.fm.previews = {}
+            _PreviewCache.get(self.fm).clear()
+        else:
+            path = self.fm.thisdir.path
+            for previewed in list(self.fm.previews):
+                if previewed == path or previewed.startswith(path.rstrip('/') + '/'):
+                    del self.fm.previews[previewed]
+            _PreviewCache.get(self.fm).invalidate(path)
         self.fm.ui.need_redraw = True
 
 
+class thumbnail_dir(Command):
+    """:thumbnail_dir [-f] [<directory>]
+
+    Create thumbnails of the images, videos, PDFs and fonts in the current
+    directory or <directory> in the background, several at a time.  They
+    are stored in the freedesktop.org thumbnail cache and shown as image
+    previews when preview_images is set.  Up to date thumbnails are only
+    made again with -f.
+    """
+
+    workers = 4
+
+    def execute(self):
+        force = self.arg(1) == '-f'
+        directory = self.rest(2 if force else 1)
+        directory = os.path.abspath(os.path.expanduser(directory)) if directory \
+            else self.fm.thisdir.path
+        try:
+            names = sorted(os.listdir(directory))
+        except OSError as ex:
+            self.fm.notify(ex, bad=True)
+            return
+        paths = []
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and _thumbnailer_for(path) is not None \
+                    and (force or _valid_thumbnail(path) is None):
+                paths.append(path)
+        if not paths:
+            self.fm.notify('No thumbnails to create')
+            return
+        self.fm.loader.add(_ThumbnailLoader(self.fm, paths, self.workers))
+
+    def tab(self, tabnum):
+        return self._tab_directory_content()
+
+
 # Version control commands
 # --------------------------------
 